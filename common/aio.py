@@ -0,0 +1,94 @@
+"""asyncio backend of common.mapreduce, Python 3.5+ only.
+
+All tasks run concurrently on one thread, in a private event loop; the
+number of tasks awaiting at the same time is limited by a semaphore.
+Mapped functions are expected to be coroutine functions, e.g. using an
+asynchronous HTTP client:
+
+    async def exists(key, url):
+        async with session.head(url) as response:
+            return response.status == 200
+
+Regular functions work too, but block the loop and so run one at a time.
+"""
+
+import asyncio
+import collections
+import inspect
+import logging
+import time
+
+# default max number of concurrently running coroutines
+CONCURRENCY = 1000
+
+logger = logging.getLogger("ghd.mapreduce")
+
+
+async def _attempt(func, key, value, retries, backoff, semaphore):
+    """ Coroutine version of mapreduce._attempt, also returns latency """
+    async with semaphore:
+        start = time.time()
+        for i in range(retries + 1):
+            try:
+                res = func(key, value)
+                if inspect.isawaitable(res):
+                    res = await res
+                return key, res, None, time.time() - start
+            except Exception as e:
+                if i == retries:
+                    return key, None, e, time.time() - start
+                logger.warning("%s failed (%s), retrying", key, e)
+                await asyncio.sleep(backoff * 2 ** i)
+
+
+async def _semaphore(concurrency):
+    # created inside the running loop, so it is bound to the right one
+    return asyncio.Semaphore(concurrency)
+
+
+def imap(func, items, concurrency, ordered, buffer_size, retries, backoff,
+         progress):
+    """ Generator of (key, result, exception) for (key, value) items
+    At most buffer_size items are in flight or waiting to be yielded """
+    loop = asyncio.new_event_loop()
+    semaphore = loop.run_until_complete(
+        _semaphore(concurrency or CONCURRENCY))
+    # tasks not yet yielded, in order of submission if ordered
+    pending = collections.deque() if ordered else set()
+    items = iter(items)
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < buffer_size:
+                try:
+                    key, value = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                task = loop.create_task(_attempt(
+                    func, key, value, retries, backoff, semaphore))
+                progress.submitted()
+                if ordered:
+                    pending.append(task)
+                else:
+                    pending.add(task)
+            if not pending:
+                break
+            if ordered:
+                # the rest of tasks keep running while waiting for this one
+                done = [loop.run_until_complete(pending.popleft())]
+            else:
+                tasks, _ = loop.run_until_complete(asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED))
+                pending.difference_update(tasks)
+                done = [task.result() for task in tasks]
+            for key, res, error, latency in done:
+                progress.add(failed=int(error is not None), latency=latency)
+                yield key, res, error
+    finally:
+        for task in pending:  # the generator was closed early
+            task.cancel()
+        if pending:
+            loop.run_until_complete(
+                asyncio.gather(*pending, return_exceptions=True))
+        loop.close()
@@ -1,26 +1,156 @@
 
+import atexit
+import gzip
+import hashlib
+import inspect
+import io
+import json
 import os
+import pickle
+import struct
+import threading
 import time
 import logging
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 from functools import wraps
 
+import numpy as np
 import pandas as pd
 
+from common import manifest
+from common import threadpool
+
 try:
     import settings
 except ImportError:
     settings = object()
 
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import zstandard as zstd
+except ImportError:  # optional, only required for zstd compressed caches
+    zstd = None
+
 
 def mkdir(*args):
     path = ''
     for chunk in args:
         path = os.path.join(path, chunk)
         if not os.path.isdir(path):
-            os.mkdir(path)
+            try:
+                os.mkdir(path)
+            except OSError:  # created by a concurrent process
+                if not os.path.isdir(path):
+                    raise
     return path
 
 
+@contextmanager
+def file_lock(fpath, blocking=True):
+    """ Exclusive inter-process lock on a file, blocks until acquired.
+    flock() is released by OS if the holding process dies, so stale lock
+    files are harmless. Lock files are kept; if one is removed while
+    another process waits on it (see remove_lock_file()), the waiter
+    notices it holds an unlinked file and locks the new one instead.
+    Yields True if the lock is acquired; with blocking=False, yields False
+    instead of waiting for a lock held by someone else.
+    Without fcntl (i.e. on Windows) it does nothing
+    """
+    if fcntl is None:
+        yield True
+        return
+    while True:
+        fh = open(fpath, 'a')
+        try:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | (
+                    0 if blocking else fcntl.LOCK_NB))
+            except (IOError, OSError):  # busy, only raised if non-blocking
+                busy = True
+            else:
+                busy = False
+            if busy:
+                yield False
+                return
+            try:
+                current = os.stat(fpath)
+            except OSError:  # removed while we were waiting
+                current = None
+            if current is not None and \
+                    current.st_ino == os.fstat(fh.fileno()).st_ino:
+                try:
+                    yield True
+                finally:
+                    fcntl.flock(fh, fcntl.LOCK_UN)
+                return
+        finally:
+            fh.close()
+
+
+def remove_lock_file(fpath):
+    # type: (str) -> bool
+    """ Remove a lock file of file_lock() unless it is currently held
+    Returns True if the file was removed """
+    if fcntl is None:
+        os.remove(fpath)
+        return True
+    with open(fpath, 'a') as fh:
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):  # in use
+            return False
+        try:
+            os.remove(fpath)
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+    return True
+
+
+# number of lock files shared by all fs_cache entries of a dataset
+LOCK_STRIPES = 256
+_held_stripes = threading.local()
+
+
+def stripe_lock_fname(locks_path, key):
+    # type: (str, str) -> str
+    """ Path of the lock file guarding the key, one of LOCK_STRIPES files
+    in locks_path. Stable across processes, unlike hash() """
+    stripe = int(hashlib.md5(key.encode("utf8")).hexdigest(), 16) \
+        % LOCK_STRIPES
+    return os.path.join(locks_path, "%02x.lock" % stripe)
+
+
+@contextmanager
+def stripe_lock(locks_path, key):
+    """ file_lock() on a lock file shared by keys of the same stripe
+    Unrelated keys of a stripe are serialized, which also applies to nested
+    calls (e.g. a cached function calling another one). To avoid deadlocks,
+    the stripe is reentrant within a thread and a thread holding a stripe
+    doesn't wait for another one: if it is busy, the nested key is
+    processed without the lock. Yields True if the lock is held
+    """
+    fpath = stripe_lock_fname(locks_path, key)
+    held = getattr(_held_stripes, 'fpaths', None)
+    if held is None:
+        held = _held_stripes.fpaths = set()
+    if fpath in held:
+        yield True
+        return
+    mkdir(locks_path)
+    with file_lock(fpath, blocking=not held) as locked:
+        if locked:
+            held.add(fpath)
+        try:
+            yield locked
+        finally:
+            held.discard(fpath)
+
+
 DEFAULT_EXPIRY = 3600 * 24 * 30 * 3
 DATASET_PATH = getattr(settings, 'DATASET_PATH', None) or \
     os.path.join(os.path.dirname(__file__), '..', '.cache')
@@ -31,93 +161,952 @@ def _argstring(*args):
     return "_".join([str(arg).replace("/", ".") for arg in args])
 
 
+def cache_version(version):
+    """ Declare version of a function cached by fs_cache with hashed keys.
+    Bump it when changes in the function or its helpers should invalidate
+    cached results:
+
+        @fs_cache
+        @cache_version(2)
+        def monthly_data(ecosystem, feature):
+            ...
+    """
+    def decorator(func):
+        func.cache_version = version
+        return func
+    return decorator
+
+
+def func_version(func):
+    # type: (callable) -> str
+    """ Declared version of a function or, if not declared, a hash of its
+    source code (any edit will invalidate cached results) """
+    version = getattr(func, 'cache_version', None)
+    if version is not None:
+        return str(version)
+    try:
+        source = inspect.getsource(func)
+    except (IOError, TypeError):  # e.g. defined in interactive shell
+        source = func.__code__.co_code
+    if not isinstance(source, bytes):
+        source = source.encode('utf8')
+    return hashlib.sha1(source).hexdigest()[:8]
+
+
+def _arghash(func_name, version, *args):
+    # type: (str, str, *object) -> str
+    """ Collision-free hash of normalized arguments
+    >>> _arghash('f', '1', 'a/b') != _arghash('f', '1', 'a.b')
+    True
+    >>> _arghash('f', '1', 'a') == _arghash('f', '1', u'a')
+    True
+    >>> _arghash('f', '1', 'a') != _arghash('f', '2', 'a')
+    True
+    """
+    key = json.dumps([func_name, version, args], default=str)
+    return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+
+def _as_frame(res):
+    return pd.DataFrame(res) if isinstance(res, pd.Series) else res
+
+
+def _squeeze(df):
+    """ Same as read_csv(squeeze=True): single column frames become Series """
+    return df.iloc[:, 0] if len(df.columns) == 1 else df
+
+
+COMPRESSION_EXTENSIONS = {'gzip': 'gz', 'zstd': 'zst'}
+ZSTD_LEVEL = 3
+
+
+@contextmanager
+def open_compressed(fpath, mode, compression=None):
+    """ Open file for binary streaming (de)compression
+    :param mode: 'rb' or 'wb'
+    :param compression: {None|gzip|zstd}
+    """
+    if compression is not None and \
+            compression not in COMPRESSION_EXTENSIONS:
+        raise ValueError("Unsupported compression: %s" % compression)
+    if compression == 'zstd' and zstd is None:
+        raise ImportError("zstd compression requires zstandard package")
+    with open(fpath, mode) as fh:
+        if compression is None:
+            yield fh
+        elif compression == 'gzip':
+            with gzip.GzipFile(fileobj=fh, mode=mode) as gzfh:
+                yield gzfh
+        elif 'w' in mode:
+            writer = zstd.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(fh)
+            try:
+                yield writer
+            finally:
+                writer.close()  # writes end of frame
+        else:
+            # buffered for readline(), used by pickle
+            yield io.BufferedReader(zstd.ZstdDecompressor().stream_reader(fh))
+
+
+class Serializer(object):
+    """ Base class for fs_cache storage formats
+    Subclasses only need to define file extension, dump() and load()
+    """
+    extension = None
+    # if True, compression is done by the format itself, i.e. compressed
+    # files don't need an extra extension
+    internal_compression = False
+
+    def dump(self, res, fpath, compression=None):
+        # type: (pd.DataFrame, str, str) -> None
+        raise NotImplementedError
+
+    def load(self, fpath, idx, compression=None):
+        # type: (str, int, str) -> pd.DataFrame
+        raise NotImplementedError
+
+
+class CSVSerializer(Serializer):
+    """ Legacy format. Slow, loses dtypes (e.g. empty strings become NaN),
+    but human readable """
+    extension = "csv"
+
+    def dump(self, res, fpath, compression=None):
+        df = _as_frame(res)
+        if compression is None:
+            df.to_csv(fpath, float_format="%g", encoding="utf-8")
+            return
+        # pandas only writes text to real files, so render it first
+        data = df.to_csv(None, float_format="%g", encoding="utf-8")
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        with open_compressed(fpath, 'wb', compression) as fh:
+            fh.write(data)
+
+    def load(self, fpath, idx, compression=None):
+        if compression is None:
+            return pd.read_csv(fpath, index_col=range(idx), encoding="utf8",
+                               squeeze=True)
+        with open_compressed(fpath, 'rb', compression) as fh:
+            return pd.read_csv(fh, index_col=range(idx), encoding="utf8",
+                               squeeze=True)
+
+
+class PickleSerializer(Serializer):
+    """ Stores result as is, i.e. Series stays Series and dtypes, index
+    and column labels are preserved exactly.
+    On Python 3.8+ it is pickle protocol 5 """
+    extension = "pkl"
+
+    def dump(self, res, fpath, compression=None):
+        if compression is None:
+            res.to_pickle(fpath, protocol=pickle.HIGHEST_PROTOCOL)
+            return
+        with open_compressed(fpath, 'wb', compression) as fh:
+            pickle.dump(res, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, fpath, idx, compression=None):
+        if compression is None:
+            return pd.read_pickle(fpath)
+        with open_compressed(fpath, 'rb', compression) as fh:
+            return pickle.load(fh)
+
+
+class ParquetSerializer(Serializer):
+    """ Columnar format, requires pyarrow.
+    Preserves dtypes and (multi)indexes. Column labels are stored as str,
+    their original dtype (e.g. int or datetime) is restored on load.
+    Compression is applied per column chunk, snappy if not specified """
+    extension = "parquet"
+    internal_compression = True
+    # key of file metadata holding dtype of column labels
+    columns_key = b"ghd.columns_dtype"
+
+    def dump(self, res, fpath, compression=None):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        df = _as_frame(res)
+        columns_dtype = str(df.columns.dtype)
+        # a copy: the caller gets the result with its original labels
+        table = pa.Table.from_pandas(df.rename(columns=str))
+        metadata = dict(table.schema.metadata or {})
+        metadata[self.columns_key] = columns_dtype.encode("utf8")
+        pq.write_table(table.replace_schema_metadata(metadata), fpath,
+                       compression=compression or 'snappy')
+
+    def load(self, fpath, idx, compression=None):
+        import pyarrow.parquet as pq
+        table = pq.read_table(fpath)
+        df = table.to_pandas()
+        columns_dtype = (table.schema.metadata or {}).get(self.columns_key)
+        if columns_dtype is not None and \
+                columns_dtype.decode("utf8") != "object":
+            df.columns = df.columns.astype(columns_dtype.decode("utf8"))
+        return _squeeze(df)
+
+
+class FeatherSerializer(Serializer):
+    """ Fastest to load, requires pyarrow.
+    Feather doesn't support indexes, so they're stored as first idx columns.
+    Column labels are stored as str. Compression is not supported """
+    extension = "feather"
+    # names assigned to unnamed index levels by .reset_index()
+    _unnamed = ("index", "level_")
+
+    def dump(self, res, fpath, compression=None):
+        if compression is not None:
+            raise ValueError("Feather cache files can't be compressed")
+        df = _as_frame(res).reset_index()
+        df.columns = df.columns.map(str)
+        df.to_feather(fpath)
+
+    def load(self, fpath, idx, compression=None):
+        df = pd.read_feather(fpath)
+        df = df.set_index(list(df.columns[:idx]), drop=True)
+        df.index.names = [None if name.startswith(self._unnamed) else name
+                          for name in df.index.names]
+        return _squeeze(df)
+
+
+class MatrixSerializer(Serializer):
+    """ Dense numeric matrices, e.g. monthly_data() project x month frames.
+    Values are stored as raw int32 (if all integer; int64 if they don't fit)
+    or float32 array in column-major order, preceded by a JSON header with
+    row and column labels. Loaded frames are backed by a read-only memory
+    map: loading is almost instant, pages are shared by processes through
+    OS cache and column slices only read pages of these columns.
+    Compression is not supported """
+    extension = "mtx"
+    magic = b"GHDMTX1\n"
+    alignment = 64  # data offset, to keep memory map aligned
+
+    @staticmethod
+    def _int_dtype(values):
+        if values.size and (values.min() < -2 ** 31 or
+                            values.max() >= 2 ** 31):
+            return np.int64
+        return np.int32
+
+    @classmethod
+    def _dtype(cls, df):
+        values = df.values
+        if values.dtype.kind in "biu":
+            return cls._int_dtype(values)
+        if values.dtype.kind != "f":
+            raise ValueError("Only numeric matrices can be stored as .mtx")
+        # counts often become floats after reindex/fillna
+        if np.isfinite(values).all() and (values == np.round(values)).all() \
+                and np.abs(values).max() < 2 ** 63:
+            return cls._int_dtype(values)
+        return np.float32
+
+    def dump(self, res, fpath, compression=None):
+        if compression is not None:
+            raise ValueError("Matrix cache files can't be compressed")
+        df = _as_frame(res)
+        if isinstance(df.index, pd.MultiIndex) or \
+                isinstance(df.columns, pd.MultiIndex):
+            raise ValueError("MultiIndex is not supported by .mtx format")
+        dtype = np.float32 if df.empty else self._dtype(df)
+        header = json.dumps({
+            'dtype': np.dtype(dtype).str,
+            'shape': df.shape,
+            'order': 'F',
+            'index': df.index.tolist(),
+            'columns': df.columns.tolist(),
+            'names': [df.index.name, df.columns.name],
+        }, default=str).encode("utf8")
+        prefix_len = len(self.magic) + 8 + len(header)
+        padding = -prefix_len % self.alignment
+        with open(fpath, 'wb') as fh:
+            fh.write(self.magic)
+            fh.write(struct.pack("<Q", len(header) + padding))
+            fh.write(header + b" " * padding)
+            fh.write(np.asfortranarray(df.values, dtype=dtype).tobytes('F'))
+
+    def load(self, fpath, idx, compression=None):
+        with open(fpath, 'rb') as fh:
+            if fh.read(len(self.magic)) != self.magic:
+                raise ValueError("Not a matrix cache file: %s" % fpath)
+            header_len, = struct.unpack("<Q", fh.read(8))
+            header = json.loads(fh.read(header_len).decode("utf8"))
+        shape = tuple(header['shape'])
+        if 0 in shape:  # can't map empty file regions
+            values = np.empty(shape, dtype=header['dtype'])
+        else:
+            values = np.memmap(fpath, dtype=header['dtype'], mode='r',
+                               offset=len(self.magic) + 8 + header_len,
+                               # row-major in files of older versions
+                               shape=shape, order=header.get('order', 'C'))
+        index_name, columns_name = header['names']
+        df = pd.DataFrame(
+            values, copy=False,
+            index=pd.Index(header['index'], name=index_name),
+            columns=pd.Index(header['columns'], name=columns_name))
+        return _squeeze(df)
+
+
+SERIALIZERS = {
+    'csv': CSVSerializer(),
+    'pickle': PickleSerializer(),
+    'parquet': ParquetSerializer(),
+    'feather': FeatherSerializer(),
+    'mtx': MatrixSerializer(),
+}
+DEFAULT_SERIALIZER = getattr(settings, 'CACHE_SERIALIZER', None) or 'csv'
+
+
+def get_serializer(serializer):
+    # type: (str) -> Serializer
+    """ Resolve serializer name into a Serializer instance
+    >>> get_serializer('csv').extension
+    'csv'
+    >>> get_serializer('xls')
+    Traceback (most recent call last):
+        ...
+    ValueError: Unsupported cache serializer: xls
+    """
+    if isinstance(serializer, Serializer):
+        return serializer
+    if serializer not in SERIALIZERS:
+        raise ValueError("Unsupported cache serializer: %s" % serializer)
+    return SERIALIZERS[serializer]
+
+
+MemoryCacheInfo = namedtuple(
+    'MemoryCacheInfo', ['hits', 'misses', 'entries', 'nbytes', 'max_bytes'])
+
+
+def _nbytes(res):
+    # type: (pd.DataFrame) -> int
+    usage = res.memory_usage(index=True, deep=True)
+    if isinstance(usage, pd.Series):  # DataFrame; Series returns a number
+        usage = usage.sum()
+    return int(usage)
+
+
+class MemoryCache(object):
+    """ Process-local LRU store for fs_cache results, bounded by total size
+    of stored objects (as estimated by .memory_usage(deep=True)).
+    One instance can be shared by several fs_cache decorators.
+
+    Size of an object is estimated once, when it is stored. By default
+    stored objects are copied on the way in and out, so callers are free to
+    modify returned values (e.g. user_info() reassigns package_urls() index).
+    Copying is O(size) on every hit; if callers never modify results, pass
+    copy=False to share stored objects instead
+
+    >>> mc = MemoryCache(10 ** 6)
+    >>> mc.get('key') is None
+    True
+    >>> mc.put('key', pd.Series(range(10)))
+    >>> int(mc.get('key').sum())
+    45
+    >>> mc.cache_info().hits, mc.cache_info().misses, mc.cache_info().entries
+    (1, 1, 1)
+    >>> mc.put('big', pd.Series(range(10 ** 6)))  # doesn't fit, not stored
+    >>> mc.get('big') is None
+    True
+    """
+    def __init__(self, max_bytes, copy=True):
+        self.max_bytes = max_bytes
+        self.copy = copy
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        # _data[key] = (value, timestamp, nbytes), most recently used last
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, expires=None):
+        """ Return stored value (a copy, unless copy=False), or None if it
+        is missing or older than expires seconds """
+        item = self.get_item(key, expires)
+        return item and item[0]
+
+    def get_item(self, key, expires=None):
+        """ Same as get(), but return (value, timestamp) to tell the age of
+        the value, or None """
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None and expires is not None \
+                    and time.time() - item[1] > expires:
+                self.nbytes -= item[2]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._data[key] = item
+            self.hits += 1
+        return item[0].copy() if self.copy else item[0], item[1]
+
+    def put(self, key, value, timestamp=None, nbytes=None):
+        """ Store a value
+        :param nbytes: size of the value, if already known """
+        if nbytes is None:
+            nbytes = _nbytes(value)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[2]
+            while self._data and self.nbytes + nbytes > self.max_bytes:
+                _, (_, _, evicted_nbytes) = self._data.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+            if self.copy:
+                value = value.copy()
+            self._data[key] = (value, timestamp or time.time(), nbytes)
+            self.nbytes += nbytes
+
+    def discard(self, *keys):
+        with self._lock:
+            for key in keys:
+                item = self._data.pop(key, None)
+                if item is not None:
+                    self.nbytes -= item[2]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = self.hits = self.misses = 0
+
+    def cache_info(self):
+        return MemoryCacheInfo(self.hits, self.misses, len(self._data),
+                               self.nbytes, self.max_bytes)
+
+
+# shared by caches of hot, repeatedly loaded functions (raw scraper data,
+# package_urls etc); set CACHE_MEMORY_LIMIT = 0 in settings.py to disable
+CACHE_MEMORY_LIMIT = getattr(settings, 'CACHE_MEMORY_LIMIT', 2 ** 30)
+memory_cache = MemoryCache(CACHE_MEMORY_LIMIT)
+
+# how often collected cache statistics are written to the manifest, seconds
+STATS_FLUSH_INTERVAL = 60
+
+
+class CacheStats(object):
+    """ Per function hit/miss/latency counters of fs_cache, memoize and
+    cached_method. Counters are aggregated in memory and periodically (and
+    on exit) added to cumulative statistics in the dataset manifest, so
+    they can be inspected across runs with `manage.py cache_stats` """
+    def __init__(self, ds_path=DATASET_PATH):
+        self.ds_path = ds_path
+        self._counters = {}  # (kind, func): [hits, misses, ...]
+        self._lock = threading.Lock()
+        self._flushed = time.time()
+
+    def record(self, kind, func_name, **counters):
+        """ Increment counters, any of manifest.STATS_FIELDS """
+        with self._lock:
+            values = self._counters.setdefault(
+                (kind, func_name), [0] * len(manifest.STATS_FIELDS))
+            for i, field in enumerate(manifest.STATS_FIELDS):
+                values[i] += counters.get(field, 0)
+            flush = time.time() - self._flushed > STATS_FLUSH_INTERVAL
+        if flush:
+            self.flush()
+
+    def snapshot(self):
+        # type: () -> pd.DataFrame
+        """ Counters collected by this process since the last flush """
+        with self._lock:
+            records = [key + tuple(values)
+                       for key, values in self._counters.items()]
+        return _stats_frame(records)
+
+    def flush(self):
+        with self._lock:
+            records = [key + tuple(values)
+                       for key, values in self._counters.items()]
+            self._counters.clear()
+            self._flushed = time.time()
+        if records:
+            manifest.get_manifest(self.ds_path).add_stats(records)
+
+
+def _stats_frame(records):
+    df = pd.DataFrame(records, columns=('kind', 'func') +
+                      manifest.STATS_FIELDS).set_index(['kind', 'func'])
+    df['hit_ratio'] = df['hits'] / (df['hits'] + df['misses']).clip(lower=1)
+    return df
+
+
+cache_stats = CacheStats()
+atexit.register(cache_stats.flush)
+
+
+def get_cache_stats():
+    # type: () -> pd.DataFrame
+    """ Cumulative statistics of all cache decorators, including
+    counters of this process not flushed yet """
+    cache_stats.flush()
+    return _stats_frame(manifest.get_manifest(DATASET_PATH).stats())
+
+
+def _func_name(func):
+    return "%s.%s" % (func.__module__, func.__name__)
+
+
+def atomic_dump(serializer, res, fpath, compression=None):
+    # type: (Serializer, pd.DataFrame, str, str) -> None
+    """ Write result to a temp file and rename it, so that concurrent
+    readers never see a partially written cache file """
+    # unlike mkstemp(), keeps default file permissions
+    tmp_fpath = "%s.%d.%d.tmp" % (
+        fpath, os.getpid(), threading.current_thread().ident)
+    try:
+        serializer.dump(res, tmp_fpath, compression)
+        # atomic on POSIX, replaces existing file
+        os.rename(tmp_fpath, fpath)
+    finally:
+        if os.path.isfile(tmp_fpath):
+            os.remove(tmp_fpath)
+
+
+# stale-while-revalidate background refresh settings
+REFRESH_WORKERS = getattr(settings, 'CACHE_REFRESH_WORKERS', None) or 4
+# max number of pending refreshes; extra stale hits don't schedule refresh
+REFRESH_QUEUE_SIZE = getattr(settings, 'CACHE_REFRESH_QUEUE_SIZE', None) or 64
+_refreshing = set()  # cache paths scheduled for refresh
+_refresh_lock = threading.Lock()
+_refresh_pool = None
+
+
+def _get_refresh_pool():
+    global _refresh_pool
+    with _refresh_lock:
+        if _refresh_pool is None:
+            # daemon threads: pending refreshes shouldn't block exit,
+            # and atomic writes make it safe to abandon them
+            _refresh_pool = threadpool.ThreadPool(REFRESH_WORKERS, daemon=True)
+        return _refresh_pool
+
+
+KEY_SCHEMES = ('legacy', 'hashed')
+DEFAULT_KEY_SCHEME = getattr(settings, 'CACHE_KEY_SCHEME', None) or 'legacy'
+# max length of human readable arguments part of hashed file names
+READABLE_PREFIX_LENGTH = 80
+
+
 class fs_cache(object):
+    """ Cache function results (pd.DataFrame or pd.Series) in files
+    Entries are recorded in the dataset manifest (see common.manifest), so
+    freshness checks and invalidation don't need to scan the cache folder.
+    Files not recorded yet (e.g. created before the manifest) are still
+    found on disk; they are registered by `manage.py cache_gc`
+
+    :param memory: optional in-memory tier on top of files. Either max size
+        in bytes of a private MemoryCache or a MemoryCache instance to share
+    :param key_scheme: how arguments are mapped to file names:
+        - legacy: <func>.<args>.<ext>, args joined with "/" replaced by "."
+        - hashed: <shard>/<func>.<args prefix>.<hash>.<ext>, where hash
+            covers normalized arguments and function version (see
+            cache_version()) and shard is the first two hex digits of it
+    :param version: version of all decorated functions, overrides
+        cache_version() and source code hashes. Only used by hashed scheme
+    :param max_stale: enables stale-while-revalidate mode: entries expired
+        less than max_stale seconds ago are returned immediately and
+        recomputed in background. Older entries are recomputed synchronously
+    :param compression: {None|gzip|zstd} compress cache files, adds .gz or
+        .zst to file extension (except parquet, which compresses internally).
+        Existing uncompressed entries are read and migrated on first access
+    """
 
     def __init__(self, app_name, idx=1, cache_type='',
-                 expires=DEFAULT_EXPIRY, ds_path=DATASET_PATH):
+                 expires=DEFAULT_EXPIRY, ds_path=DATASET_PATH,
+                 serializer=DEFAULT_SERIALIZER, memory=None,
+                 key_scheme=DEFAULT_KEY_SCHEME, version=None,
+                 max_stale=None, compression=None):
+        assert key_scheme in KEY_SCHEMES, \
+            "Unsupported cache key scheme: %s" % key_scheme
+        if compression is not None and \
+                compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError("Unsupported compression: %s" % compression)
         self.expires = expires
+        self.max_stale = max_stale
         self.idx = idx
+        self.key_scheme = key_scheme
+        self.version = version
+        self.serializer = get_serializer(serializer)
+        self.compression = compression
+        self.extension = self.serializer.extension
+        if compression is not None and \
+                not self.serializer.internal_compression:
+            self.extension += "." + COMPRESSION_EXTENSIONS[compression]
+        if memory is not None and not isinstance(memory, MemoryCache):
+            memory = MemoryCache(memory)
+        self.memory = memory
         if not app_name:
-            self.cache_path = ds_path
+            cache_path = ds_path
         else:
-            self.cache_path = mkdir(ds_path, app_name + ".cache", cache_type)
+            cache_path = mkdir(ds_path, app_name + ".cache", cache_type)
+        # manifest paths have to match regardless of working directory
+        self.cache_path = os.path.abspath(cache_path)
+        self.manifest = manifest.get_manifest(ds_path)
+        # striped lock files of all caches in the dataset, see stripe_lock()
+        self.locks_path = os.path.join(os.path.abspath(ds_path), "locks")
 
     def get_cache_fname(self, func_name, *args, **kwargs):
         chunks = [func_name]
         if args:
             chunks.append(_argstring(*args))
-        chunks.append(kwargs.get("extension", "csv"))
+        chunks.append(kwargs.get("extension", self.extension))
         return os.path.join(self.cache_path, ".".join(chunks))
 
+    def get_hashed_fname(self, func_name, version, *args):
+        arghash = _arghash(func_name, version, *args)
+        chunks = [func_name]
+        if args:
+            chunks.append(_argstring(*args)[:READABLE_PREFIX_LENGTH])
+        chunks.extend([arghash[:20], self.extension])
+        return os.path.join(self.cache_path, arghash[:2], ".".join(chunks))
+
+    def created(self, cache_fpath):
+        # type: (str) -> float
+        """ Return creation timestamp of a cache file, None if missing """
+        entry = self.manifest.lookup(cache_fpath)
+        if entry is not None:
+            return entry.created
+        # files written outside of fs_cache, e.g. so.adjacency_matrix()
+        if os.path.isfile(cache_fpath):
+            return os.path.getmtime(cache_fpath)
+        return None
+
     def expired(self, cache_fpath):
-        return not os.path.isfile(cache_fpath) \
-               or time.time() - os.path.getmtime(cache_fpath) > self.expires
+        created = self.created(cache_fpath)
+        return created is None or time.time() - created > self.expires
 
-    def __call__(self, func):
-        @wraps(func)
-        def wrapper(*args):
-            cache_fpath = self.get_cache_fname(func.__name__, *args)
+    def load(self, cache_fpath, func_name=None):
+        """ Read cached value, None if the file was removed behind our back
+        (e.g. manually or by cache_gc in another process)
+        If func_name is given, the hit is recorded in cache_stats """
+        start = time.time()
+        try:
+            res = self.serializer.load(
+                cache_fpath, self.idx, self.compression)
+        except (IOError, OSError):
+            if os.path.isfile(cache_fpath):
+                raise
+            self.manifest.discard(cache_fpath)
+            return None
+        if func_name is not None:
+            cache_stats.record(
+                'fs_cache', func_name, hits=1, load_time=time.time() - start,
+                bytes_read=os.path.getsize(cache_fpath))
+        if self.memory is not None:
+            self.memory.put(cache_fpath, res, self.created(cache_fpath))
+        return res
 
+    def compute(self, func, args, cache_fpath):
+        """ Call the function and store the result.
+        Single flight: only one process (or thread) computes a missing entry,
+        others wait for the lock and read the result """
+        func_name = _func_name(func)
+        mkdir(os.path.dirname(cache_fpath))  # hashed scheme shard
+        with stripe_lock(self.locks_path, cache_fpath):
             if not self.expired(cache_fpath):
-                return pd.read_csv(cache_fpath, index_col=range(self.idx),
-                                   encoding="utf8", squeeze=True)
+                res = self.load(cache_fpath, func_name)
+                if res is not None:
+                    return res
 
+            start = time.time()
             res = func(*args)
+            compute_time = time.time() - start
             if isinstance(res, pd.DataFrame):
-                df = res
-                if len(df.columns) == 1 and self.idx == 1:
+                if len(res.columns) == 1 and self.idx == 1:
                     logging.warning(
                         "Single column dataframe is returned by %s.\nSince it "
                         "will cause inconsistent behavior with @fs_cache "
                         "decorator, please consider changing result type "
                         "to pd.Series", func.__name__)
-            elif isinstance(res, pd.Series):
-                df = pd.DataFrame(res)
-            else:
+            elif not isinstance(res, pd.Series):
                 raise ValueError("Unsupported result type (pd.DataFrame or "
                                  "pd.Series expected, got %s)" % type(res))
-            df.to_csv(cache_fpath, float_format="%g", encoding="utf-8")
-            return res
+            atomic_dump(self.serializer, res, cache_fpath, self.compression)
+            size = os.path.getsize(cache_fpath)
+            self.manifest.add(
+                cache_fpath, self.cache_path, func.__name__,
+                _argstring(*args), size, expires=self.expires)
+            self.remove_legacy(cache_fpath)
+            cache_stats.record('fs_cache', func_name, misses=1,
+                               compute_time=compute_time, bytes_written=size)
+            if self.memory is not None:
+                self.memory.put(cache_fpath, res)
+        return res
+
+    def legacy_fname(self, cache_fpath):
+        # type: (str) -> str
+        """ Path of uncompressed entry stored before compression was enabled,
+        None if compression is not used """
+        if self.extension == self.serializer.extension:
+            return None
+        return cache_fpath[:-len(self.extension)] + self.serializer.extension
+
+    def remove_legacy(self, cache_fpath):
+        """ Remove uncompressed copy of a recomputed entry, if any """
+        legacy_fpath = self.legacy_fname(cache_fpath)
+        if legacy_fpath is None:
+            return
+        if os.path.isfile(legacy_fpath):
+            os.remove(legacy_fpath)
+        self.manifest.discard(legacy_fpath)
+
+    def migrate(self, cache_fpath):
+        # type: (str) -> float
+        """ Compress uncompressed entry stored before compression was enabled
+        Returns creation timestamp of the entry, None if there is nothing to
+        migrate. Original timestamp is kept, so expiration isn't reset.
+        Expired entries are not migrated; they are removed when recomputed """
+        legacy_fpath = self.legacy_fname(cache_fpath)
+        if legacy_fpath is None:
+            return None
+        created = self.created(legacy_fpath)
+        if created is None or time.time() - created > self.expires:
+            return None
+        with stripe_lock(self.locks_path, cache_fpath):
+            if not os.path.isfile(legacy_fpath):  # migrated by another worker
+                return self.created(cache_fpath)
+            res = self.serializer.load(legacy_fpath, self.idx)
+            atomic_dump(self.serializer, res, cache_fpath, self.compression)
+            os.utime(cache_fpath, (created, created))
+            os.remove(legacy_fpath)
+            self.manifest.discard(legacy_fpath)
+            func_name, args = manifest.parse_fname(
+                os.path.basename(legacy_fpath))
+            self.manifest.add(
+                cache_fpath, self.cache_path, func_name, args,
+                os.path.getsize(cache_fpath), created, self.expires)
+        return created
+
+    def refresh(self, func, args, cache_fpath):
+        """ Schedule recomputation of a stale entry in background """
+        with _refresh_lock:
+            if cache_fpath in _refreshing or \
+                    len(_refreshing) >= REFRESH_QUEUE_SIZE:
+                return
+            _refreshing.add(cache_fpath)
+
+        def do():
+            try:
+                self.compute(func, args, cache_fpath)
+            finally:
+                with _refresh_lock:
+                    _refreshing.discard(cache_fpath)
+
+        _get_refresh_pool().submit(do)
+
+    def __call__(self, func):
+        version = self.key_scheme == 'hashed' and (
+            self.version or func_version(func))
+        func_name = _func_name(func)
+
+        @wraps(func)
+        def wrapper(*args):
+            if self.key_scheme == 'hashed':
+                cache_fpath = self.get_hashed_fname(
+                    func.__name__, version, *args)
+            else:
+                cache_fpath = self.get_cache_fname(func.__name__, *args)
+
+            if self.memory is not None:
+                max_age = self.expires
+                if self.max_stale is not None:
+                    max_age += self.max_stale
+                item = self.memory.get_item(cache_fpath, max_age)
+                if item is not None:
+                    res, created = item
+                    if time.time() - created > self.expires:  # stale
+                        self.refresh(func, args, cache_fpath)
+                    cache_stats.record('fs_cache', func_name, hits=1)
+                    return res
+
+            created = self.created(cache_fpath)
+            if created is None and self.compression is not None:
+                created = self.migrate(cache_fpath)
+            age = created is not None and time.time() - created
+            if created is not None and age <= self.expires:
+                res = self.load(cache_fpath, func_name)
+                if res is not None:
+                    return res
+            elif created is not None and self.max_stale is not None \
+                    and age <= self.expires + self.max_stale:
+                res = self.load(cache_fpath, func_name)
+                if res is not None:
+                    self.refresh(func, args, cache_fpath)
+                    return res
+
+            return self.compute(func, args, cache_fpath)
         return wrapper
 
     def invalidate(self, func):
         """ Remove all files caching this function """
-        for fname in os.listdir(self.cache_path):
-            if fname.startswith(func.__name__):
-                os.remove(os.path.join(self.cache_path, fname))
+        # register entries created before the manifest, once per folder
+        self.manifest.scan(self.cache_path, self.expires)
+        paths = [entry.path for entry in
+                 self.manifest.entries(self.cache_path, func.__name__)]
+        if self.memory is not None:
+            self.memory.discard(*paths)
+        for path in paths:
+            if os.path.isfile(path):
+                os.remove(path)
+        self.manifest.discard(*paths)
 
 
-def typed_fs_cache(app_name, expires=DEFAULT_EXPIRY):
-    # type: (str, int) -> callable
+def typed_fs_cache(app_name, expires=DEFAULT_EXPIRY,
+                   serializer=DEFAULT_SERIALIZER, memory=None,
+                   key_scheme=DEFAULT_KEY_SCHEME, max_stale=None,
+                   compression=None):
+    # type: (str, int, str, MemoryCache, str, int, object) -> callable
+    """ fs_cache factory with a subfolder per cache type
+    :param compression: either compression for all cache types, or a dict
+        {cache_type: compression}; types missing in the dict are uncompressed
+    """
     def _cache(cache_type, idx=1):
-        return fs_cache(app_name, idx, cache_type=cache_type, expires=expires)
+        if isinstance(compression, dict):
+            type_compression = compression.get(cache_type)
+        else:
+            type_compression = compression
+        return fs_cache(app_name, idx, cache_type=cache_type, expires=expires,
+                        serializer=serializer, memory=memory,
+                        key_scheme=key_scheme, max_stale=max_stale,
+                        compression=type_compression)
 
     return _cache
 
 
-def memoize(func):
-    """ Classical memoize for non-class methods """
-    cache = {}
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+# default number of entries kept by memoize()
+MEMOIZE_MAXSIZE = 128
+
+
+def _memo_key(args):
+    try:
+        hash(args)
+    except TypeError:  # e.g. lists; fall back to string representation
+        return tuple(str(arg) for arg in args)
+    return args
+
+
+class MemoStore(object):
+    """ Thread-safe LRU store for memoize and cached_method.
+    Concurrent callers of a missing key wait for a single computation
+    instead of computing it in parallel (single flight).
+
+    :param maxsize: max number of entries, None for unbounded
+    :param ttl: max age of entries in seconds, None to keep forever
+    """
+    def __init__(self, maxsize=MEMOIZE_MAXSIZE, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key: (value, timestamp)
+        self._pending = {}  # key: threading.Event set when computed
+        self._lock = threading.Lock()
+
+    def get(self, key, compute, stats_key=None):
+        """ Return cached value for the key, or compute it with compute()
+        :param stats_key: (kind, func name) to record in cache_stats
+        """
+        while True:
+            with self._lock:
+                item = self._data.pop(key, None)
+                if item is not None and (
+                        self.ttl is None or time.time() - item[1] <= self.ttl):
+                    self._data[key] = item  # move to the end
+                    self.hits += 1
+                    break
+                item = None  # missing or expired
+                event = self._pending.get(key)
+                if event is None:
+                    event = self._pending[key] = threading.Event()
+                    break
+            # another thread is computing it; if it fails, try ourselves
+            event.wait()
+
+        if item is not None:  # hit
+            if stats_key is not None:
+                cache_stats.record(*stats_key, hits=1)
+            return item[0]
+
+        start = time.time()
+        try:
+            value = compute()
+            with self._lock:
+                self.misses += 1
+                self._data[key] = (value, time.time())
+                while self.maxsize is not None and \
+                        len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        finally:
+            # also on KeyboardInterrupt etc., or waiters would hang forever
+            with self._lock:
+                del self._pending[key]
+            event.set()
+        if stats_key is not None:
+            cache_stats.record(*stats_key, misses=1,
+                               compute_time=time.time() - start)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+
+def memoize(func=None, maxsize=MEMOIZE_MAXSIZE, ttl=None):
+    """ Classical memoize for non-class methods, thread-safe and bounded.
+    Can be used both as @memoize and @memoize(maxsize=2, ttl=3600)
+
+    >>> @memoize(maxsize=2)
+    ... def square(x):
+    ...     return x ** 2
+    >>> square(2), square(2), square(3), square(4)
+    (4, 4, 9, 16)
+    >>> square.cache_info()
+    CacheInfo(hits=1, misses=3, maxsize=2, currsize=2)
+    >>> square.cache_clear()
+    >>> square.cache_info().currsize
+    0
+    """
+    if func is None:
+        return lambda f: memoize(f, maxsize=maxsize, ttl=ttl)
+
+    store = MemoStore(maxsize, ttl)
+    stats_key = ('memoize', _func_name(func))
 
     @wraps(func)
     def wrapper(*args):
-        key = "__".join(str(arg) for arg in args)
-        if key not in cache:
-            cache[key] = func(*args)
-        return cache[key]
+        return store.get(_memo_key(args), lambda: func(*args), stats_key)
+
+    wrapper.cache_info = store.cache_info
+    wrapper.cache_clear = store.clear
     return wrapper
 
 
+# guards creation of per-instance stores by cached_method
+_instance_store_lock = threading.Lock()
+
+
 def cached_method(func):
-    """ Classical memoize for non-class methods """
+    """ Classical memoize for class methods
+    Results are stored per instance, so they live as long as the object """
+    stats_key = ('cached_method', _func_name(func))
+
     @wraps(func)
     def wrapper(self, *args):
-        if not hasattr(self, "_cache"):
-            self._cache = {}
-        key = "__".join((func.__name__,) + args)
-        if key not in self._cache:
-            self._cache[key] = func(self, *args)
-        return self._cache[key]
+        store = getattr(self, "_cache", None)
+        if store is None:
+            with _instance_store_lock:
+                if getattr(self, "_cache", None) is None:
+                    self._cache = MemoStore(maxsize=None)
+                store = self._cache
+        return store.get(_memo_key((func.__name__,) + args),
+                         lambda: func(self, *args), stats_key)
     return wrapper
 
 
@@ -0,0 +1,457 @@
+"""Compact monthly dependency graph of an ecosystem.
+
+upstreams() used to be a package x month DataFrame of Python sets, forward
+filled over ~160 months, i.e. the same set repeated in every column. Here
+package names are interned to integer ids and every distinct dependency set
+is stored once, as a CSR (compressed sparse row) array of ids. Packages
+only keep a timeline of changes: (month, dependency set) of releases that
+changed dependencies. Dependencies in any month are looked up from there,
+as a CSR adjacency of the whole graph:
+
+    >>> releases = pd.DataFrame({
+    ...     'name': ['a', 'a', 'b', 'c'],
+    ...     'month': ['2017-01', '2017-03', '2017-02', '2017-02'],
+    ...     'deps': ['b', 'b,c', '', 'd']})
+    >>> g = DependencyGraph.from_releases(releases)
+    >>> g.packages.tolist()
+    ['a', 'b', 'c']
+    >>> indptr, indices = g.snapshot('2017-02')
+    >>> indptr.tolist(), g.names[indices].tolist()
+    ([0, 1, 1, 2], ['b', 'd'])
+    >>> sorted(g.upstreams().loc['a', '2017-03'])
+    ['b', 'c']
+
+Graphs are saved to and loaded from a binary file; loaded arrays are
+memory mapped, so warm starts don't need to rebuild the graph.
+
+EdgeTable is a temporal view of the same graph, with the interval of
+months every edge was valid for; use it to update monthly results
+incrementally from edges added and removed since the previous month.
+"""
+
+import collections
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+import pandas as pd
+
+MAGIC = b"GHDGRAPH1\n"
+ALIGNMENT = 64  # array offsets, to keep memory maps aligned
+# saved arrays, in the order of storage
+ARRAYS = ('indptr', 'change_month', 'change_set', 'set_indptr',
+          'set_indices')
+
+
+def month_number(months):
+    """ Convert 'YYYY-MM' labels into integers counting months since year 0
+    >>> month_number(pd.Series(['2017-12', '2018-01'])).tolist()
+    [24215, 24216]
+    """
+    months = pd.Series(months).astype(str)
+    return (months.str[:4].astype(int) * 12 +
+            months.str[5:7].astype(int) - 1).values.astype(np.int32)
+
+
+def month_label(number):
+    """ Inverse of month_number() for a single month
+    >>> month_label(24215)
+    '2017-12'
+    """
+    return "%04d-%02d" % (number // 12, number % 12 + 1)
+
+
+def month_labels(start, end='now'):
+    """ Month labels of the same range as used by upstreams() columns
+    >>> month_labels('2017-11', '2018-02')
+    ['2017-11', '2017-12', '2018-01']
+    """
+    return [dt.strftime("%Y-%m")
+            for dt in pd.date_range(start, end, freq="M")]
+
+
+def transpose(indptr, indices, n_rows):
+    """ Reverse CSR adjacency, dropping edges to ids >= n_rows
+    >>> indptr, indices = transpose(np.array([0, 2, 3]), np.array([1, 2, 0]), 2)
+    >>> indptr.tolist(), indices.tolist()
+    ([0, 1, 2], [1, 0])
+    """
+    rows = np.repeat(np.arange(len(indptr) - 1, dtype=indices.dtype),
+                     np.diff(indptr))
+    keep = indices < n_rows
+    rows, cols = rows[keep], indices[keep]
+    # stable sort keeps rows sorted within every reversed row
+    order = np.argsort(cols, kind='mergesort')
+    new_indptr = np.zeros(n_rows + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cols, minlength=n_rows), out=new_indptr[1:])
+    return new_indptr, rows[order]
+
+
+class DependencyGraph(object):
+    """ Dependencies of all packages in all months
+
+    :param names: array of interned names, position is the id. First
+        n_packages of them are packages with releases, sorted; the rest are
+        dependencies never released themselves (e.g. in another registry)
+    :param indptr: changes of package i are [indptr[i], indptr[i+1])
+    :param change_month: month number (see month_number()) of every change,
+        increasing within a package
+    :param change_set: id of dependency set of every change
+    :param set_indptr: CSR of distinct dependency sets; dependencies of
+        set j are set_indices[set_indptr[j]:set_indptr[j+1]]
+    :param set_indices: sorted name ids of dependencies
+    """
+    def __init__(self, names, n_packages, indptr, change_month, change_set,
+                 set_indptr, set_indices):
+        self.names = np.asarray(names, dtype=object)
+        self.n_packages = n_packages
+        self.indptr = indptr
+        self.change_month = change_month
+        self.change_set = change_set
+        self.set_indptr = set_indptr
+        self.set_indices = set_indices
+        self._ids = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_releases(cls, releases):
+        # type: (pd.DataFrame) -> DependencyGraph
+        """ Build the graph from releases, already cleaned of alpha releases
+        and backports
+
+        :param releases: pd.DataFrame with name, month and deps columns,
+            at most one release per package per month. deps is a comma
+            separated string of dependencies, empty or NaN if none
+        """
+        releases = releases.sort_values(
+            ['name', 'month'], kind='mergesort')
+        packages, rows = np.unique(
+            releases['name'].values.astype(object), return_inverse=True)
+
+        # parse every distinct string once, then intern equal sets
+        codes, uniques = pd.factorize(releases['deps'])
+        parsed = [set(deps.split(",")) if deps else set()
+                  for deps in uniques]
+        extra = set().union(*parsed).difference(packages)
+        names = np.concatenate(
+            [packages, np.array(sorted(extra), dtype=object)])
+        ids = {name: i for i, name in enumerate(names)}
+        set_ids = {(): 0}  # NaN deps, code -1, is the empty set too
+        uniques_sets = np.zeros(len(uniques) + 1, dtype=np.int32)
+        for code, deps in enumerate(parsed):
+            key = tuple(sorted(ids[name] for name in deps))
+            uniques_sets[code] = set_ids.setdefault(key, len(set_ids))
+        sets = sorted(set_ids, key=set_ids.get)
+        set_indptr = np.zeros(len(sets) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in sets], out=set_indptr[1:])
+        set_indices = np.fromiter(
+            (i for s in sets for i in s), dtype=np.int32,
+            count=set_indptr[-1])
+
+        # only keep releases that changed dependencies
+        change_set = uniques_sets[codes]
+        keep = np.ones(len(rows), dtype=bool)
+        keep[1:] = (rows[1:] != rows[:-1]) | \
+            (change_set[1:] != change_set[:-1])
+        rows = rows[keep]
+        indptr = np.zeros(len(packages) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(packages)),
+                  out=indptr[1:])
+        return cls(names, len(packages), indptr,
+                   month_number(releases['month'].values[keep]),
+                   change_set[keep], set_indptr, set_indices)
+
+    @property
+    def packages(self):
+        return self.names[:self.n_packages]
+
+    def ids(self, names):
+        """ Ids of names, -1 for unknown ones """
+        with self._lock:
+            if self._ids is None:
+                self._ids = {name: i for i, name in enumerate(self.names)}
+        return np.array([self._ids.get(name, -1) for name in names],
+                        dtype=np.int64)
+
+    def months(self, end='now'):
+        """ Month labels from the first release till end """
+        if not len(self.change_month):
+            return []
+        return month_labels(month_label(int(self.change_month.min())), end)
+
+    def _month_sets(self, months):
+        # type: (list) -> np.ndarray
+        """ Dependency set ids of packages x months, -1 before the first
+        release of a package """
+        numbers = month_number(months)
+        # position of the change in every (package, month) cell, 1-based
+        positions = np.zeros((self.n_packages, len(numbers)), dtype=np.int64)
+        rows = np.repeat(np.arange(self.n_packages), np.diff(self.indptr))
+        columns = np.searchsorted(numbers, self.change_month)
+        # changes after the last month are ignored; changes before the
+        # first one land in the first column and are overridden by later ones.
+        # Fancy assignment doesn't define which of duplicate cells wins,
+        # so the latest change is picked explicitly
+        valid = columns < len(numbers)
+        np.maximum.at(positions, (rows[valid], columns[valid]),
+                      np.arange(1, len(rows) + 1)[valid])
+        # changes are sorted, so the latest one has the highest position
+        np.maximum.accumulate(positions, axis=1, out=positions)
+        return np.where(positions > 0, self.change_set[positions - 1], -1)
+
+    def snapshot(self, month, reverse=False):
+        # type: (str, bool) -> (np.ndarray, np.ndarray)
+        """ CSR adjacency of dependencies as of the month: dependencies of
+        package i are indices[indptr[i]:indptr[i+1]]
+        :param reverse: return dependent packages instead, i.e. downstreams
+        """
+        set_ids = self._month_sets([month])[:, 0]
+        lengths = np.where(set_ids >= 0, np.diff(self.set_indptr)[set_ids], 0)
+        indptr = np.zeros(self.n_packages + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        # position of every edge in set_indices
+        offsets = np.repeat(self.set_indptr[set_ids] - indptr[:-1], lengths)
+        indices = self.set_indices[np.arange(indptr[-1]) + offsets]
+        if reverse:
+            return transpose(indptr, indices, self.n_packages)
+        return indptr, indices
+
+    def upstreams(self, end='now'):
+        # type: (str) -> pd.DataFrame
+        """ The same DataFrame as used to be returned by utils.upstreams():
+        df.loc[package, month] = set([upstreams]), NaN before the first
+        release. Cells with equal sets might be the same object, so they
+        should not be modified in place """
+        columns = self.months(end)
+        sets = np.empty(len(self.set_indptr), dtype=object)
+        sets[:-1] = [set(self.names[self.set_indices[start:stop]])
+                     for start, stop in zip(self.set_indptr[:-1],
+                                            self.set_indptr[1:])]
+        sets[-1] = np.nan  # set id -1
+        return pd.DataFrame(
+            sets[self._month_sets(columns)],
+            columns=pd.Index(columns, name='month'),
+            index=pd.Index(self.packages, name='name'))
+
+    def downstreams(self, end='now'):
+        # type: (str) -> pd.DataFrame
+        """ The same DataFrame as used to be returned by utils.downstreams():
+        df.loc[package, month] = set([packages depending on it]), NaN if
+        there are none. Only packages from the index are counted.
+        Built incrementally from monthly edge deltas, so sets of packages
+        that didn't change are shared between months, like in upstreams() """
+        columns = self.months(end)
+        edges = EdgeTable.from_graph(self)
+        res = np.empty((self.n_packages, len(columns)), dtype=object)
+        # downstreams as of the current month
+        cells = np.full(self.n_packages, np.nan, dtype=object)
+        for i, month in enumerate(columns):
+            added, removed = edges.delta(month)
+            changes = collections.defaultdict(lambda: (set(), set()))
+            for edge_ids, j in ((added, 0), (removed, 1)):
+                for src, dst in zip(self.names[edges.src[edge_ids]],
+                                    edges.dst[edge_ids]):
+                    if dst < self.n_packages:
+                        changes[dst][j].add(src)
+            for dst, (dst_added, dst_removed) in changes.items():
+                cell = cells[dst]
+                # a new set object, the old one is used by previous months
+                cell = (set(cell) if isinstance(cell, set) else set()) \
+                    .difference(dst_removed).union(dst_added)
+                cells[dst] = cell or np.nan
+            res[:, i] = cells
+        return pd.DataFrame(res, columns=pd.Index(columns, name='month'),
+                            index=pd.Index(self.packages, name='name'))
+
+    def save(self, fpath):
+        """ Store the graph in a binary file: a JSON header with names and
+        array layout, followed by raw arrays. Written to a temp file and
+        renamed, so concurrent readers never see a partial graph """
+        arrays = [np.ascontiguousarray(getattr(self, name))
+                  for name in ARRAYS]
+        layout = []
+        offset = 0
+        for name, array in zip(ARRAYS, arrays):
+            layout.append((name, array.dtype.str, len(array), offset))
+            offset += array.nbytes + (-array.nbytes % ALIGNMENT)
+        header = json.dumps({
+            'names': self.names.tolist(),
+            'n_packages': self.n_packages,
+            'arrays': layout,
+        }).encode("utf8")
+        prefix_len = len(MAGIC) + 8 + len(header)
+        header += b" " * (-prefix_len % ALIGNMENT)
+
+        tmp_fpath = "%s.%d.%d.tmp" % (
+            fpath, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp_fpath, 'wb') as fh:
+                fh.write(MAGIC)
+                fh.write(struct.pack("<Q", len(header)))
+                fh.write(header)
+                for array in arrays:
+                    fh.write(array.tobytes())
+                    fh.write(b"\0" * (-array.nbytes % ALIGNMENT))
+            os.rename(tmp_fpath, fpath)
+        finally:
+            if os.path.isfile(tmp_fpath):
+                os.remove(tmp_fpath)
+
+    @classmethod
+    def load(cls, fpath):
+        # type: (str) -> DependencyGraph
+        """ Read a graph stored by save(); arrays are read-only memory maps
+        """
+        with open(fpath, 'rb') as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                raise ValueError("Not a dependency graph file: %s" % fpath)
+            header_len, = struct.unpack("<Q", fh.read(8))
+            header = json.loads(fh.read(header_len).decode("utf8"))
+        data_offset = len(MAGIC) + 8 + header_len
+        arrays = {}
+        for name, dtype, length, offset in header['arrays']:
+            if not length:  # can't map empty file regions
+                arrays[name] = np.empty(0, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(
+                    fpath, dtype=dtype, mode='r', shape=(length,),
+                    offset=data_offset + offset)
+        return cls(header['names'], header['n_packages'],
+                   *[arrays[name] for name in ARRAYS])
+
+
+class EdgeTable(object):
+    """ Temporal index of dependency edges: every edge is valid for an
+    interval of months [valid_from, valid_to), i.e. from the release
+    that added the dependency till the one that removed it.
+    It answers point-in-time queries and, unlike DependencyGraph, tells
+    what changed between months, so monthly consumers can update their
+    state instead of rebuilding it every month:
+
+    >>> releases = pd.DataFrame({
+    ...     'name': ['a', 'a', 'a', 'b'],
+    ...     'month': ['2017-01', '2017-03', '2017-05', '2017-02'],
+    ...     'deps': ['b', 'b,c', 'c', 'a']})
+    >>> edges = EdgeTable.from_graph(DependencyGraph.from_releases(releases))
+    >>> df = edges.to_frame()
+    >>> df.loc[0].tolist()
+    ['a', 'b', '2017-01', '2017-05']
+    >>> df['valid_to'].tolist()
+    ['2017-05', None, None]
+    >>> added, removed = edges.changes('2017-02', '2017-05')
+    >>> df['dependency'][added].tolist(), df['dependency'][removed].tolist()
+    (['c'], ['b'])
+
+    Arrays are sorted by (src, dst, valid_from), valid_to of edges that
+    are still valid is OPEN. Months are month_number() integers.
+
+    :param names: interned names, same as DependencyGraph.names
+    :param src: name ids of dependent packages
+    :param dst: name ids of dependencies
+    """
+    OPEN = np.iinfo(np.int32).max
+
+    def __init__(self, names, n_packages, src, dst, valid_from, valid_to):
+        self.names = names
+        self.n_packages = n_packages
+        self.src = src
+        self.dst = dst
+        self.valid_from = valid_from
+        self.valid_to = valid_to
+
+    @classmethod
+    def from_graph(cls, graph):
+        # type: (DependencyGraph) -> EdgeTable
+        # every (package, dependency, change) triple
+        n_changes = len(graph.change_set)
+        lengths = np.diff(graph.set_indptr)[graph.change_set]
+        offsets = np.zeros(n_changes + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        change = np.repeat(np.arange(n_changes), lengths)
+        dst = graph.set_indices[np.arange(offsets[-1]) + np.repeat(
+            graph.set_indptr[graph.change_set] - offsets[:-1], lengths)]
+        packages = np.repeat(np.arange(graph.n_packages, dtype=np.int32),
+                             np.diff(graph.indptr))
+        src = packages[change]
+
+        # consecutive changes of a package keeping a dependency are merged
+        # into a single interval
+        order = np.lexsort((change, dst, src))
+        src, dst, change = src[order], dst[order], change[order]
+        starts = np.ones(len(src), dtype=bool)
+        starts[1:] = (src[1:] != src[:-1]) | (dst[1:] != dst[:-1]) | \
+            (change[1:] != change[:-1] + 1)
+        starts = np.flatnonzero(starts)
+        ends = np.append(starts[1:], len(src)) - 1
+        # the interval ends with the next change of the package, if any
+        next_change = change[ends] + 1
+        has_next = next_change < graph.indptr[src[ends] + 1]
+        valid_to = np.full(len(starts), cls.OPEN, dtype=np.int32)
+        valid_to[has_next] = graph.change_month[next_change[has_next]]
+        return cls(graph.names, graph.n_packages, src[starts], dst[starts],
+                   graph.change_month[change[starts]], valid_to)
+
+    def __len__(self):
+        return len(self.src)
+
+    def _valid(self, month):
+        # type: (int) -> np.ndarray
+        return (self.valid_from <= month) & (self.valid_to > month)
+
+    def snapshot(self, month, reverse=False):
+        # type: (str, bool) -> (np.ndarray, np.ndarray)
+        """ Same as DependencyGraph.snapshot() """
+        valid = self._valid(month_number([month])[0])
+        src, dst = self.src[valid], self.dst[valid]
+        indptr = np.zeros(self.n_packages + 1, dtype=np.int64)
+        np.cumsum(np.bincount(src, minlength=self.n_packages),
+                  out=indptr[1:])
+        if reverse:
+            return transpose(indptr, dst, self.n_packages)
+        return indptr, dst
+
+    def changes(self, start, end):
+        # type: (str, str) -> (np.ndarray, np.ndarray)
+        """ Edges added and removed between two months, i.e. edges valid in
+        end but not in start month and vice versa. Edges removed and added
+        back in between (or the other way around) are not reported
+        :return: (added, removed) arrays of edge positions in the table
+        """
+        start, end = month_number([start, end])
+        if start > end:
+            removed, added = self.changes(month_label(end), month_label(start))
+            return added, removed
+        added = np.flatnonzero(self._valid(end) & (self.valid_from > start))
+        removed = np.flatnonzero(self._valid(start) & (self.valid_to <= end))
+        # the same edge can have several intervals
+        pairs = self.src.astype(np.int64) * len(self.names) + self.dst
+        readded = np.in1d(pairs[added], pairs[removed])
+        if readded.any():
+            restored = pairs[added[readded]]
+            added = added[~readded]
+            removed = removed[~np.in1d(pairs[removed], restored)]
+        return added, removed
+
+    def delta(self, month):
+        # type: (str) -> (np.ndarray, np.ndarray)
+        """ Edges added and removed in the month, see changes() """
+        number = month_number([month])[0]
+        added = np.flatnonzero(self.valid_from == number)
+        removed = np.flatnonzero(self.valid_to == number)
+        return added, removed
+
+    def to_frame(self):
+        # type: () -> pd.DataFrame
+        """ Table of (package, dependency, valid_from, valid_to) labels,
+        valid_to is None for edges that are still valid """
+        labels = {number: month_label(number) for number in
+                  np.unique(np.concatenate([self.valid_from, self.valid_to]))}
+        labels[self.OPEN] = None
+        return pd.DataFrame({
+            'package': self.names[self.src],
+            'dependency': self.names[self.dst],
+            'valid_from': [labels[n] for n in self.valid_from],
+            'valid_to': [labels[n] for n in self.valid_to],
+        }, columns=['package', 'dependency', 'valid_from', 'valid_to'])
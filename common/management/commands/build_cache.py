@@ -3,10 +3,10 @@ from __future__ import print_function, unicode_literals
 
 import logging
 
-from django.conf import settings
 from django.core.management.base import BaseCommand
 
 from common import mapreduce
+from common import throttle
 from common import utils as common
 import scraper
 
@@ -19,9 +19,13 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('ecosystem', type=str,
                             help='Ecosystem to process, {pypi|npm}')
-        num_tokens = len(getattr(settings, 'SCRAPER_GITHUB_API_TOKENS', []))
-        parser.add_argument('-w', '--workers', default=1+num_tokens//2,
-                            type=int, help='Number of workers to use')
+        # actual concurrency is adjusted by common.throttle
+        parser.add_argument('-w', '--workers',
+                            default=throttle.HOST_LIMITS['api.github.com'],
+                            type=int, help='Max number of workers to use')
+        parser.add_argument('-s', '--status',
+                            help='JSON file to write progress to, '
+                                 'in addition to the log')
 
     def handle(self, *args, **options):
         # -v 3: DEBUG, 2: INFO, 1: WARNING (default), 0: ERROR
@@ -34,7 +38,7 @@ class Command(BaseCommand):
         urls = common.package_urls(options['ecosystem'])
 
         def collect_scraper(package, url):
-            logger.info(package)
+            logger.debug(package)
             try:
                 scraper.commits(url)
             except scraper.RepoDoesNotExist:
@@ -42,4 +46,9 @@ class Command(BaseCommand):
                 return
             scraper.issues(url)
 
-        mapreduce.map(collect_scraper, urls, num_workers=num_workers)
+        _, failed = mapreduce.map(collect_scraper, urls,
+                                  num_workers=num_workers, retries=2,
+                                  return_failed=True,
+                                  progress=options['status'] or True)
+        for package, error in failed.items():
+            logger.error("%s: %s", package, error)
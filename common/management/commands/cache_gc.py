@@ -0,0 +1,131 @@
+from __future__ import print_function, unicode_literals
+
+import logging
+import os
+import re
+import time
+
+from django.core.management.base import BaseCommand
+
+from common import decorators as d
+from common import manifest as m
+
+SIZE_UNITS = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def parse_size(size):
+    # type: (str) -> int
+    """ Parse human readable size, e.g. 500M or 1.5T
+    >>> parse_size("1K")
+    1024
+    >>> parse_size("2048")
+    2048
+    """
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*$", size.upper())
+    if not match:
+        raise ValueError("Invalid size: %s" % size)
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+class Command(BaseCommand):
+    requires_system_checks = False
+    help = "Remove old fs_cache entries and enforce disk quota on the " \
+           "cache folder. Entries are looked up in the cache manifest; " \
+           "cache folders are only scanned once, to register files " \
+           "created before the manifest"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-q', '--quota', type=parse_size,
+                            help='Max total size of cache files, e.g. 200G. '
+                                 'Entries are evicted in --order until the '
+                                 'cache fits')
+        parser.add_argument('-o', '--order', default='age',
+                            choices=('age', 'size'),
+                            help='Eviction order to enforce quota: oldest or '
+                                 'largest first')
+        parser.add_argument('-a', '--max-age', type=float,
+                            help='Remove entries older than this number of '
+                                 'days')
+        parser.add_argument('-e', '--expired', action='store_true',
+                            help='Remove entries past their expiration date')
+        parser.add_argument('-r', '--rescan', action='store_true',
+                            help='Resync manifest with cache folders first, '
+                                 'e.g. if files were removed manually')
+        parser.add_argument('-l', '--locks', action='store_true',
+                            help='Remove lock files not held by any process, '
+                                 'e.g. per-entry locks of older versions. '
+                                 'Unlike other options, walks cache folders')
+        parser.add_argument('-n', '--dry-run', action='store_true',
+                            help="Only report what would be removed")
+
+    def handle(self, *args, **options):
+        loglevel = 40 - 10 * options['verbosity']
+        logging.basicConfig(level=loglevel)
+        logger = logging.getLogger('ghd.cache_gc')
+
+        manifest = m.get_manifest(d.DATASET_PATH)
+        # register files of folders not scanned yet, or all with --rescan
+        cache_paths = set(m.find_cache_paths(d.DATASET_PATH))
+        cache_paths.update(manifest.cache_paths())
+        for cache_path in sorted(cache_paths):
+            if os.path.isdir(cache_path):
+                logger.info("Scanning %s", cache_path)
+                # actual expiry is only known to fs_cache instances
+                manifest.scan(cache_path, d.DEFAULT_EXPIRY,
+                              force=options['rescan'])
+
+        stats = {'files': 0, 'bytes': 0}
+        removed = set()  # matters for dry runs only
+
+        def remove(entries):
+            for entry in entries:
+                if entry.path in removed:
+                    continue
+                removed.add(entry.path)
+                logger.info("Removing %s", entry.path)
+                stats['files'] += 1
+                stats['bytes'] += entry.size
+                if options['dry_run']:
+                    continue
+                if os.path.isfile(entry.path):
+                    os.remove(entry.path)
+                manifest.discard(entry.path)
+
+        if options['expired']:
+            remove(manifest.expired())
+
+        if options['max_age'] is not None:
+            remove(manifest.older_than(
+                time.time() - options['max_age'] * 24 * 3600))
+
+        if options['quota'] is not None:
+            excess = manifest.total_size() - options['quota']
+            if options['dry_run']:  # nothing was actually removed
+                excess -= stats['bytes']
+            order = 'created' if options['order'] == 'age' else 'size DESC'
+            evicted = []
+            for entry in manifest.entries(order_by=order):
+                if excess <= 0:
+                    break
+                if entry.path in removed:
+                    continue
+                evicted.append(entry)
+                excess -= entry.size
+            remove(evicted)
+
+        if options['locks']:
+            locks = 0
+            for root, _, fnames in os.walk(d.DATASET_PATH):
+                for fname in fnames:
+                    if not fname.endswith('.lock'):
+                        continue
+                    fpath = os.path.join(root, fname)
+                    logger.debug("Removing lock file %s", fpath)
+                    if options['dry_run'] or d.remove_lock_file(fpath):
+                        locks += 1
+            print("%s %d lock files" % (
+                "Would remove" if options['dry_run'] else "Removed", locks))
+
+        print("%s %d files, %.1f MB" % (
+            "Would remove" if options['dry_run'] else "Removed",
+            stats['files'], stats['bytes'] / 2.0 ** 20))
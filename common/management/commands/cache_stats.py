@@ -0,0 +1,48 @@
+from __future__ import print_function, unicode_literals
+
+import pandas as pd
+from django.core.management.base import BaseCommand
+
+from common import decorators as d
+from common import manifest as m
+
+
+class Command(BaseCommand):
+    requires_system_checks = False
+    help = "Show cumulative hit/miss, latency and I/O statistics of " \
+           "fs_cache, memoize and cached_method per decorated function"
+
+    def add_arguments(self, parser):
+        parser.add_argument('-s', '--sort', default='compute_time',
+                            choices=m.STATS_FIELDS + ('hit_ratio',),
+                            help='Column to sort by, descending')
+        parser.add_argument('-k', '--kind',
+                            choices=('fs_cache', 'memoize', 'cached_method'),
+                            help='Only show this type of cache')
+        parser.add_argument('-n', '--limit', type=int,
+                            help='Only show top N functions')
+        parser.add_argument('--reset', action='store_true',
+                            help='Clear collected statistics')
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            m.get_manifest(d.DATASET_PATH).reset_stats()
+            return
+
+        df = d.get_cache_stats()
+        if options['kind'] is not None:
+            df = df[df.index.get_level_values('kind') == options['kind']]
+        df = df.sort_values(options['sort'], ascending=False)
+        if options['limit'] is not None:
+            df = df.iloc[:options['limit']]
+        if df.empty:
+            print("No cache statistics collected yet")
+            return
+
+        df['MB_read'] = df.pop('bytes_read') / 2.0 ** 20
+        df['MB_written'] = df.pop('bytes_written') / 2.0 ** 20
+        with pd.option_context('display.width', 200,
+                               'display.max_columns', None,
+                               'display.max_rows', None,
+                               'display.float_format', '{:.3f}'.format):
+            print(df)
@@ -0,0 +1,130 @@
+from __future__ import print_function, unicode_literals
+
+import fnmatch
+import logging
+import os
+
+from django.core.management.base import BaseCommand
+
+from common import decorators as d
+
+
+def parse_idx(value):
+    # type: (str) -> (str, int)
+    """ Parse --idx value, either number of index columns for all files or
+    pattern=number for files matching the pattern
+    >>> parse_idx("2")
+    ('*', 2)
+    >>> parse_idx("commits.*=2")
+    ('commits.*', 2)
+    """
+    pattern, _, idx = value.rpartition("=")
+    return pattern or '*', int(idx)
+
+
+def dataset_path(path):
+    # type: (str) -> str
+    """ Dataset folder of a cache path, i.e. the closest one with a
+    manifest. The path itself if there is no manifest yet """
+    path = dataset = os.path.abspath(path)
+    while not os.path.isfile(os.path.join(dataset, d.manifest.MANIFEST_FNAME)):
+        parent = os.path.dirname(dataset)
+        if parent == dataset:
+            return path
+        dataset = parent
+    return dataset
+
+
+class Command(BaseCommand):
+    requires_system_checks = False
+    help = "Convert existing fs_cache files into another storage format " \
+           "or compression in place. Set CACHE_SERIALIZER in settings.py " \
+           "(or fs_cache compression) to the same format afterwards, " \
+           "otherwise converted files will be ignored."
+
+    def add_arguments(self, parser):
+        compressions = sorted(d.COMPRESSION_EXTENSIONS.keys())
+        parser.add_argument('serializer', type=str,
+                            help='Target format, {%s}' % "|".join(
+                                sorted(d.SERIALIZERS.keys())))
+        parser.add_argument('-s', '--source', default='csv', type=str,
+                            help='Source format, csv by default')
+        parser.add_argument('-c', '--compression', choices=compressions,
+                            help='Target compression, none by default')
+        parser.add_argument('--source-compression', choices=compressions,
+                            help='Source compression, none by default')
+        parser.add_argument('-p', '--path', default=d.DATASET_PATH,
+                            help='Cache folder to convert, recursively. '
+                                 'Defaults to DATASET_PATH')
+        parser.add_argument('-i', '--idx', nargs='+', type=parse_idx,
+                            default=[('*', 1)],
+                            help='Number of index columns in cached files, '
+                                 'same as fs_cache(idx=). Either a number '
+                                 'for all files or pattern=number, e.g. '
+                                 '1 "monthly_data.*=2". The first matching '
+                                 'pattern=number is used')
+        parser.add_argument('--include', nargs='*', default=['*'],
+                            help='File name patterns to convert, e.g. '
+                                 '"monthly_data.*" for mtx format')
+        # files written outside of fs_cache, which read them directly
+        parser.add_argument('-e', '--exclude', nargs='*',
+                            default=['.*', 'adjacency.*', 'user.emails.*'],
+                            help='File name patterns to skip')
+
+    def handle(self, *args, **options):
+        loglevel = 40 - 10 * options['verbosity']
+        logging.basicConfig(level=loglevel)
+        logger = logging.getLogger('ghd')
+
+        manifest = d.manifest.get_manifest(dataset_path(options['path']))
+        source = d.get_serializer(options['source'])
+        target = d.get_serializer(options['serializer'])
+        source_compression = options['source_compression']
+        compression = options['compression']
+        if source is target and source_compression == compression:
+            return
+
+        def extension(serializer, compression):
+            if compression is None or serializer.internal_compression:
+                return serializer.extension
+            return serializer.extension + "." + \
+                d.COMPRESSION_EXTENSIONS[compression]
+
+        # pattern-specific values take precedence over the catch-all number
+        idx_patterns = sorted(options['idx'], key=lambda item: item[0] == '*')
+
+        def idx(fname):
+            for pattern, value in idx_patterns:
+                if fnmatch.fnmatch(fname, pattern):
+                    return value
+            return 1
+
+        suffix = "." + extension(source, source_compression)
+        target_ext = extension(target, compression)
+        for root, _, fnames in os.walk(options['path']):
+            for fname in fnames:
+                if not fname.endswith(suffix) or not any(
+                        fnmatch.fnmatch(fname, pattern)
+                        for pattern in options['include']) or any(
+                        fnmatch.fnmatch(fname, pattern)
+                        for pattern in options['exclude']):
+                    continue
+                src = os.path.abspath(os.path.join(root, fname))
+                dst = src[:-len(suffix)] + "." + target_ext
+                logger.info(src)
+                try:
+                    res = source.load(src, idx(fname), source_compression)
+                except Exception as e:  # malformed or empty files
+                    logger.warning("Failed to read %s: %s", src, e)
+                    continue
+                try:
+                    d.atomic_dump(target, res, dst, compression)
+                except Exception as e:
+                    # e.g. non-numeric data for mtx, compressed feather
+                    logger.warning("Failed to convert %s: %s", src, e)
+                    continue
+                # keep the original mtime, so expiration isn't reset
+                stat = os.stat(src)
+                os.utime(dst, (stat.st_atime, stat.st_mtime))
+                os.remove(src)
+                manifest.move(src, dst, os.path.getsize(dst))
@@ -0,0 +1,271 @@
+"""Index of files stored by fs_cache.
+
+With hundreds of thousands of cache files in a single folder, listing and
+stat'ing them becomes the bottleneck. Instead, every entry written by
+fs_cache is recorded in an SQLite database, so that freshness checks, prefix
+invalidation and expiration sweeps are index lookups.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+try:
+    import settings
+except ImportError:
+    settings = object()
+
+MANIFEST_FNAME = "manifest.sqlite"
+# temporary and lock files used by fs_cache, not cache entries
+SERVICE_EXTENSIONS = ('.lock', '.tmp')
+# subfolders used by hashed key scheme
+SHARD_PATTERN = re.compile(r"^[0-9a-f]{2}$")
+# extensions added to compressed cache files, e.g. .csv.gz
+COMPRESSION_SUFFIXES = ('gz', 'zst')
+# WAL journal allows concurrent reads during writes, but requires shared
+# memory and is unsafe on NFS, where DATASET_PATH often lives
+MANIFEST_WAL = getattr(settings, 'CACHE_MANIFEST_WAL', False)
+
+Entry = namedtuple(
+    'Entry', ['path', 'cache_path', 'func', 'args', 'size', 'created',
+              'expires'])
+# per function usage counters of cache decorators
+STATS_FIELDS = ('hits', 'misses', 'compute_time', 'load_time', 'bytes_read',
+                'bytes_written')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    path TEXT PRIMARY KEY,
+    cache_path TEXT NOT NULL,
+    func TEXT NOT NULL,
+    args TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    expires REAL
+);
+CREATE INDEX IF NOT EXISTS entries_func ON entries (cache_path, func);
+CREATE INDEX IF NOT EXISTS entries_created ON entries (created);
+CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires);
+CREATE TABLE IF NOT EXISTS scanned (cache_path TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS stats (
+    kind TEXT NOT NULL,
+    func TEXT NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    misses INTEGER NOT NULL DEFAULT 0,
+    compute_time REAL NOT NULL DEFAULT 0,
+    load_time REAL NOT NULL DEFAULT 0,
+    bytes_read INTEGER NOT NULL DEFAULT 0,
+    bytes_written INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (kind, func)
+);
+"""
+
+
+def _listfiles(cache_path):
+    """ List files in cache folder, including shards of fs_cache hashed key
+    scheme (two hex digits subfolders) """
+    for fname in os.listdir(cache_path):
+        fpath = os.path.join(cache_path, fname)
+        if os.path.isfile(fpath):
+            yield fpath
+        elif SHARD_PATTERN.match(fname) and os.path.isdir(fpath):
+            for shard_fname in os.listdir(fpath):
+                shard_fpath = os.path.join(fpath, shard_fname)
+                if os.path.isfile(shard_fpath):
+                    yield shard_fpath
+
+
+def find_cache_paths(ds_path):
+    """ List fs_cache folders of a dataset: <app>.cache and their cache type
+    subfolders, excluding shards of hashed key scheme """
+    for fname in sorted(os.listdir(ds_path)):
+        app_path = os.path.abspath(os.path.join(ds_path, fname))
+        if not fname.endswith(".cache") or not os.path.isdir(app_path):
+            continue
+        yield app_path
+        for type_fname in sorted(os.listdir(app_path)):
+            type_path = os.path.join(app_path, type_fname)
+            if os.path.isdir(type_path) and \
+                    not SHARD_PATTERN.match(type_fname):
+                yield type_path
+
+
+def parse_fname(fname):
+    # type: (str) -> (str, str)
+    """ Guess function name and arguments string from cache file name
+    Hashed file names will include argument hash in args
+
+    >>> parse_fname("commits.github.com.pandas-dev.pandas.csv")
+    ('commits', 'github.com.pandas-dev.pandas')
+    >>> parse_fname("packages_info.csv")
+    ('packages_info', '')
+    >>> parse_fname("commits.github.com.pandas-dev.pandas.csv.gz")
+    ('commits', 'github.com.pandas-dev.pandas')
+    """
+    chunks = fname.split(".")
+    if len(chunks) > 2 and chunks[-1] in COMPRESSION_SUFFIXES:
+        chunks.pop()
+    return chunks[0], ".".join(chunks[1:-1])
+
+
+class CacheManifest(object):
+    """ SQLite-backed registry of cache entries
+    Connections are per thread and per process (sqlite3 objects can't be
+    shared across threads, and shouldn't be inherited by forked workers)
+
+    :param wal: use WAL journal mode. Only safe on local file systems
+    """
+    def __init__(self, db_path, wal=MANIFEST_WAL):
+        self.db_path = db_path
+        self.wal = wal
+        self._local = threading.local()
+        with self.connection as conn:
+            conn.executescript(SCHEMA)
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # concurrent writers will wait up to a minute for the lock
+            conn = sqlite3.connect(self.db_path, timeout=60)
+            if self.wal:
+                conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _query(self, sql, *params):
+        return self.connection.execute(sql, params).fetchall()
+
+    def lookup(self, path):
+        # type: (str) -> Entry
+        """ Return Entry for the given file path, or None if not recorded """
+        rows = self._query("SELECT * FROM entries WHERE path = ?", path)
+        return rows and Entry(*rows[0]) or None
+
+    def add(self, path, cache_path, func, args, size, created=None,
+            expires=None):
+        created = created or time.time()
+        with self.connection as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (path, cache_path, func, args, size, created,
+                 expires and created + expires))
+
+    def discard(self, *paths):
+        with self.connection as conn:
+            conn.executemany("DELETE FROM entries WHERE path = ?",
+                             [(path,) for path in paths])
+
+    def move(self, old_path, new_path, size):
+        with self.connection as conn:
+            conn.execute("UPDATE entries SET path = ?, size = ? "
+                         "WHERE path = ?", (new_path, size, old_path))
+
+    def entries(self, cache_path=None, func=None, order_by="created"):
+        # type: (str, str, str) -> list
+        """ List entries, optionally filtered by folder and function name """
+        assert order_by in ("created", "size DESC", "expires")
+        conditions = []
+        params = []
+        if cache_path is not None:
+            conditions.append("cache_path = ?")
+            params.append(cache_path)
+        if func is not None:
+            conditions.append("func = ?")
+            params.append(func)
+        sql = "SELECT * FROM entries"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return [Entry(*row) for row in
+                self._query(sql + " ORDER BY " + order_by, *params)]
+
+    def expired(self, now=None):
+        """ List entries past their expiration date, oldest first """
+        return [Entry(*row) for row in self._query(
+            "SELECT * FROM entries WHERE expires < ? ORDER BY expires",
+            now or time.time())]
+
+    def older_than(self, timestamp):
+        return [Entry(*row) for row in self._query(
+            "SELECT * FROM entries WHERE created < ? ORDER BY created",
+            timestamp)]
+
+    def total_size(self):
+        # type: () -> int
+        return self._query("SELECT COALESCE(SUM(size), 0) FROM entries")[0][0]
+
+    def scan(self, cache_path, expires=None, force=False):
+        """ Register files existing in cache_path, only once per folder
+        This is a one time cost for caches created before the manifest was
+        introduced, or a way to resync manifest if files were removed manually.
+        Lists the whole folder, so it is only done by cache_gc and on
+        invalidation, never on import
+        """
+        if not force and self._query(
+                "SELECT 1 FROM scanned WHERE cache_path = ?", cache_path):
+            return
+        records = []
+        for fpath in _listfiles(cache_path):
+            fname = os.path.basename(fpath)
+            if fname.endswith(SERVICE_EXTENSIONS) or \
+                    fname.startswith(MANIFEST_FNAME):
+                continue
+            stat = os.stat(fpath)
+            func, args = parse_fname(fname)
+            records.append((fpath, cache_path, func, args, stat.st_size,
+                            stat.st_mtime,
+                            expires and stat.st_mtime + expires))
+        with self.connection as conn:
+            if force:
+                conn.execute("DELETE FROM entries WHERE cache_path = ?",
+                             (cache_path,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                records)
+            conn.execute("INSERT OR REPLACE INTO scanned VALUES (?)",
+                         (cache_path,))
+
+    def cache_paths(self):
+        return [row[0] for row in
+                self._query("SELECT cache_path FROM scanned")]
+
+    def add_stats(self, records):
+        """ Add counters to cumulative cache statistics
+        :param records: iterable of (kind, func) + STATS_FIELDS tuples
+        """
+        increments = ", ".join("%s = %s + ?" % (field, field)
+                               for field in STATS_FIELDS)
+        with self.connection as conn:
+            for record in records:
+                conn.execute("INSERT OR IGNORE INTO stats (kind, func) "
+                             "VALUES (?, ?)", record[:2])
+                conn.execute(
+                    "UPDATE stats SET %s WHERE kind = ? AND func = ?" %
+                    increments, tuple(record[2:]) + tuple(record[:2]))
+
+    def stats(self):
+        # type: () -> list
+        """ List cumulative cache statistics as (kind, func, *STATS_FIELDS) """
+        return self._query("SELECT * FROM stats ORDER BY kind, func")
+
+    def reset_stats(self):
+        with self.connection as conn:
+            conn.execute("DELETE FROM stats")
+
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+def get_manifest(ds_path):
+    # type: (str) -> CacheManifest
+    """ Return manifest of the given dataset folder, one per folder """
+    db_path = os.path.join(os.path.abspath(ds_path), MANIFEST_FNAME)
+    with _manifests_lock:
+        if db_path not in _manifests:
+            _manifests[db_path] = CacheManifest(db_path)
+        return _manifests[db_path]
@@ -2,12 +2,473 @@
 import pandas as pd
 
 import collections
+import contextlib
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.pool
+import os
+import pickle
+import threading
+import time
 
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+try:
+    from itertools import izip
+except ImportError:  # Python 3
+    izip = zip
+
+try:
+    from collections.abc import Iterable
+except ImportError:  # Python 2
+    from collections import Iterable
+
+from common import progress as pg
 from common import threadpool
 
+try:
+    from common import aio
+except (ImportError, SyntaxError):  # Python 2, async def is a syntax error
+    aio = None
+
+# max number of items queued for workers, keeps memory constant on large input
+QUEUE_SIZE = 1000
+# number of results written to checkpoint file at once
+CHECKPOINT_BATCH = 100
+
+logger = logging.getLogger("ghd.mapreduce")
+
+BACKENDS = ('thread', 'process', 'asyncio')
+# types of pd.DataFrame rows passed to map functions, see map()
+ROW_FORMATS = ('series', 'tuple', 'dict')
+# process backend: target number of chunks per worker. More chunks balance
+# load better, fewer reduce IPC overhead
+CHUNKS_PER_WORKER = 4
+# functions of running process maps, inherited by forked workers; this way
+# closures and lambdas don't need to be pickled
+_process_funcs = {}
+_process_funcs_counter = itertools.count()
+
 
-def map(func, data, num_workers=None):
+def _attempt(func, key, value, retries, backoff):
+    """ Call func(key, value) with retries, return (key, result, exception)
     """
+    for i in range(retries + 1):
+        try:
+            return key, func(key, value), None
+        except Exception as e:
+            if i == retries:
+                return key, None, e
+            logger.warning("%s failed (%s), retrying", key, e)
+            time.sleep(backoff * 2 ** i)
+
+
+def _map_chunk(func, chunk, retries, backoff):
+    """ Thread backend worker: map a batch of (key, value) pairs
+    Returns processing time and list of (key, result, exception) """
+    start = time.time()
+    results = [_attempt(func, key, value, retries, backoff)
+               for key, value in chunk]
+    return time.time() - start, results
+
+
+def _combine_chunk(func, combine, chunk, retries, backoff):
+    """ Map a batch of (key, value) pairs and fold results with combine
+    Returns processing time, number of items, list of failed
+    (key, exception) and tuple (True, partial), or (False, None) if no item
+    succeeded """
+    start = time.time()
+    partial = None
+    has_partial = False
+    failed = []
+    for key, value in chunk:
+        key, res, error = _attempt(func, key, value, retries, backoff)
+        if error is not None:
+            failed.append((key, error))
+            continue
+        partial = combine(partial, res) if has_partial else res
+        has_partial = True
+    return time.time() - start, len(chunk), failed, (has_partial, partial)
+
+
+def _resolve(func):
+    """ Function by the token of a function inherited on fork """
+    return func if callable(func) else _process_funcs[func]
+
+
+def _picklable(error):
+    """ Make sure exception can be sent back to the parent process """
+    try:
+        pickle.dumps(error, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return RuntimeError(repr(error))
+    return error
+
+
+def _process_chunk(args):
+    """ Process backend worker: map a chunk of (key, value) pairs """
+    func, chunk, retries, backoff = args
+    elapsed, results = _map_chunk(_resolve(func), chunk, retries, backoff)
+    return elapsed, [(key, value, error if error is None else
+                      _picklable(error)) for key, value, error in results]
+
+
+def _process_combine_chunk(args):
+    """ Process backend worker: map a chunk and combine results """
+    func, combine, chunk, retries, backoff = args
+    elapsed, n, failed, partial = _combine_chunk(
+        _resolve(func), _resolve(combine), chunk, retries, backoff)
+    return elapsed, n, [(key, _picklable(error)) for key, error in failed], \
+        partial
+
+
+def _combine_pair(args):
+    combine, a, b = args
+    return _resolve(combine)(a, b)
+
+
+def _combine_round(pool_map, combine, partials):
+    """ Combine partials pairwise in parallel, halving their number """
+    pairs = [(combine, partials[i], partials[i + 1])
+             for i in range(0, len(partials) - 1, 2)]
+    return list(pool_map(_combine_pair, pairs)) + partials[2 * len(pairs):]
+
+
+def _tree_reduce(pool_map, combine, partials):
+    """ Combine partials in log2(len(partials)) parallel rounds """
+    while len(partials) > 1:
+        partials = _combine_round(pool_map, combine, partials)
+    return partials[0]
+
+
+def _fork_context():
+    """ multiprocessing context starting workers with fork(), None if the
+    platform can't fork. Only forked workers inherit registered functions;
+    spawn and forkserver, the defaults on macOS (Python 3.8+) and Linux
+    (Python 3.14+), would have to pickle them """
+    get_context = getattr(multiprocessing, 'get_context', None)
+    if get_context is None:  # Python 2 always forks, where it can
+        return multiprocessing if hasattr(os, 'fork') else None
+    try:
+        return get_context('fork')
+    except ValueError:  # e.g. Windows
+        return None
+
+
+def _is_picklable(func):
+    try:
+        pickle.dumps(func, protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def _process_pool(num_workers, *funcs):
+    """ multiprocessing.Pool, along with references to funcs for workers
+    Workers are forked where possible and get tokens of inherited functions,
+    so closures and lambdas don't need to be pickled. Without fork(),
+    picklable funcs are sent to spawned workers; otherwise it falls back
+    to a pool of threads with the same interface """
+    num_workers = num_workers or threadpool.CPU_COUNT
+    context = _fork_context()
+    refs = funcs
+    if context is not None:
+        refs = [next(_process_funcs_counter) for _ in funcs]
+        _process_funcs.update(zip(refs, funcs))
+        # created after funcs are registered, so forked workers can see them
+        pool = context.Pool(num_workers)
+    elif all(_is_picklable(func) for func in funcs):
+        pool = multiprocessing.Pool(num_workers)
+    else:
+        logger.warning("Workers can't be forked and functions can't be "
+                       "pickled, using threads instead of processes")
+        pool = multiprocessing.pool.ThreadPool(num_workers)
+    try:
+        yield pool, refs
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        if context is not None:
+            for ref in refs:
+                _process_funcs.pop(ref, None)
+
+
+def _bounded_imap(pool, worker, tasks, max_tasks, ordered=False):
+    """ pool.imap(worker, tasks), reading tasks only as the results are
+    consumed. Pool.imap reads tasks in a background thread as fast as it
+    can; the semaphore keeps it at most max_tasks ahead of the consumer """
+    slots = threading.Semaphore(max_tasks)
+    stopped = []
+
+    def gen():
+        tasks_iter = iter(tasks)
+        while True:
+            slots.acquire()
+            if stopped:
+                return
+            try:
+                task = next(tasks_iter)
+            except StopIteration:
+                return
+            yield task
+
+    imap = pool.imap if ordered else pool.imap_unordered
+    try:
+        for res in imap(worker, gen()):
+            slots.release()
+            yield res
+    finally:
+        stopped.append(True)
+        slots.release()  # unblock the task feeder if it is waiting
+
+
+def _chunks(iterable, size):
+    iterable = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterable, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _check_args(backend, rows):
+    assert backend in BACKENDS, "Unsupported backend: %s" % backend
+    assert backend != 'asyncio' or aio is not None, \
+        "asyncio backend requires Python 3.5+"
+    assert rows in ROW_FORMATS, "Unsupported rows format: %s" % rows
+    # namedtuple classes created by .itertuples() can't be pickled
+    assert backend != 'process' or rows != 'tuple', \
+        "Process backend doesn't support rows='tuple', use 'dict' instead"
+
+
+def _items(data, rows='series'):
+    """ Iterate (key, value) pairs of data
+    :param rows: type of pd.DataFrame row values, see map()
+    """
+    if isinstance(data, pd.DataFrame) and rows != 'series':
+        if rows == 'tuple':
+            values = data.itertuples(index=False)
+        else:
+            columns = list(data.columns)
+            values = (dict(zip(columns, row))
+                      for row in data.itertuples(index=False, name=None))
+        return izip(data.index, values)
+    # pd.Series didn't have .items() until pandas 0.21,
+    # so iteritems for older versions
+    for method in ('iterrows', 'iteritems', 'items'):
+        if hasattr(data, method):
+            return getattr(data, method)()
+    return enumerate(data)
+
+
+def _batch_size(data, num_workers, batch_size, backend):
+    """ Number of items per task, see map() """
+    if batch_size is None and backend == 'process' \
+            and hasattr(data, '__len__'):
+        num_workers = num_workers or threadpool.CPU_COUNT
+        batch_size = len(data) // (num_workers * CHUNKS_PER_WORKER)
+    return max(batch_size or 1, 1)
+
+
+def _get_progress(progress, func, data, skip=0):
+    # type: (object, callable, object, int) -> pg.Progress
+    """ Progress instance for the progress argument of map() """
+    if isinstance(progress, pg.Progress):
+        return progress
+    total = len(data) - skip if hasattr(data, '__len__') else None
+    return pg.Progress(
+        getattr(func, '__name__', 'map'), total,
+        interval=pg.PROGRESS_INTERVAL if progress else None,
+        status_file=None if progress in (None, False, True) else progress)
+
+
+def _record(progress, elapsed, results):
+    """ Update progress with a processed batch """
+    progress.add(len(results), latency=elapsed / max(len(results), 1),
+                 failed=sum(error is not None for _, _, error in results))
+
+
+def _imap(func, items, num_workers, ordered, buffer_size, retries, backoff,
+          backend, batch_size, progress):
+    """ Generator of (key, result, exception) for (key, value) items
+    At most buffer_size items are in flight or waiting to be yielded, so
+    memory use doesn't depend on the input size """
+    if backend == 'asyncio':  # batches make no sense for coroutines
+        for res in aio.imap(func, items, num_workers, ordered, buffer_size,
+                            retries, backoff, progress):
+            yield res
+        return
+
+    # max number of batches in flight or waiting to be yielded
+    max_batches = max(buffer_size // batch_size, 1)
+    batches = _chunks(items, batch_size)
+    if backend == 'thread':
+        pool = threadpool.ThreadPool(n_workers=num_workers)
+        # submitted futures not yet yielded; in order of submission if ordered
+        pending = collections.deque() if ordered else set()
+        done = queue.Queue()  # completed futures, unordered mode only
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < max_batches:
+                    try:
+                        batch = next(batches)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    future = pool.submit(_map_chunk, func, batch,
+                                         retries, backoff)
+                    progress.submitted(len(batch))
+                    if ordered:
+                        pending.append(future)
+                    else:
+                        pending.add(future)
+                        future.add_done_callback(done.put)
+                if not pending:
+                    break
+                if ordered:
+                    future = pending.popleft()
+                else:
+                    future = done.get()
+                    pending.discard(future)
+                elapsed, results = future.result()
+                _record(progress, elapsed, results)
+                for res in results:
+                    yield res
+        finally:
+            for future in pending:  # the generator was closed early
+                future.cancel()
+            pool.shutdown()
+        return
+
+    def tasks(func_ref):
+        for chunk in batches:
+            progress.submitted(len(chunk))
+            yield func_ref, chunk, retries, backoff
+
+    with _process_pool(num_workers, func) as (pool, (func_ref,)):
+        for elapsed, results in _bounded_imap(
+                pool, _process_chunk, tasks(func_ref), max_batches, ordered):
+            _record(progress, elapsed, results)
+            for res in results:
+                yield res
+
+
+class Checkpoint(object):
+    """ Append-only log of completed map() keys and results.
+    Results are written in pickled batches; a batch truncated by a crash
+    is discarded on load, i.e. only its keys are recomputed
+
+    :param expires: max age of results in seconds; older batches are
+        ignored on load, i.e. their keys are recomputed
+    """
+    def __init__(self, fpath, batch_size=CHECKPOINT_BATCH, expires=None):
+        self.fpath = fpath
+        self.batch_size = batch_size
+        self.expires = expires
+        self._batch = []
+        self._lock = threading.Lock()
+
+    def load(self):
+        # type: () -> dict
+        done = {}
+        if not os.path.isfile(self.fpath):
+            return done
+        min_created = self.expires is not None and time.time() - self.expires
+        with open(self.fpath, 'rb') as fh:
+            offset = 0
+            while True:
+                try:
+                    batch = pickle.load(fh)
+                except EOFError:
+                    break
+                except Exception:  # incomplete last batch
+                    logger.warning("Discarding truncated checkpoint batch "
+                                   "in %s", self.fpath)
+                    break
+                if isinstance(batch, tuple):
+                    created, batch = batch
+                else:  # written before batches were timestamped
+                    created = None
+                if min_created is False or (
+                        created is not None and created >= min_created):
+                    done.update(batch)
+                offset = fh.tell()
+        if offset < os.path.getsize(self.fpath):
+            with open(self.fpath, 'r+b') as fh:
+                fh.truncate(offset)
+        return done
+
+    def add(self, key, value):
+        with self._lock:
+            self._batch.append((key, value))
+            if len(self._batch) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._batch:
+            return
+        with open(self.fpath, 'ab') as fh:
+            pickle.dump((time.time(), self._batch), fh,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+            fh.flush()
+            os.fsync(fh.fileno())
+        self._batch = []
+
+    def remove(self):
+        if os.path.isfile(self.fpath):
+            os.remove(self.fpath)
+
+
+def map(func, data, num_workers=None, checkpoint=None, retries=0,
+        backoff=1, return_failed=False, backend='thread', batch_size=None,
+        rows='series', progress=None, checkpoint_expires=None):
+    """ Apply func(key, value) to every item of data in parallel
+
+    :param checkpoint: path to a file recording completed keys and results,
+        to resume an interrupted run. If the file exists, these keys are not
+        processed again. It is removed once all keys are processed, even if
+        some of them failed, so the next run starts over
+    :param checkpoint_expires: max age of checkpointed results in seconds,
+        older ones are recomputed. By default they never expire
+    :param retries: number of retries of failed keys
+    :param backoff: delay before the first retry in seconds, doubled for
+        every next attempt
+    :param return_failed: return tuple (result, failed), where failed is a
+        dict of keys failed after all retries and their exceptions.
+        Otherwise failed keys are just logged and missing in the result
+        (i.e. NaN for pandas)
+    :param backend: 'thread' for IO bound func, 'process' for CPU bound.
+        Process backend defaults to one worker per CPU. On platforms with
+        fork() func can be any callable, including closures; otherwise it has
+        to be picklable, i.e. a module level function or functools.partial,
+        or it will run in threads
+        'asyncio' (Python 3.5+) is for network bound coroutine functions:
+        they all run on a single thread, num_workers (default
+        aio.CONCURRENCY) limits how many of them run at the same time
+    :param batch_size: number of items handed to a worker at once. Batches
+        cut per-task overhead when func is fast (ignored by asyncio backend,
+        which has next to no overhead per task); the thread backend defaults
+        to 1 item. The process backend by default splits input into
+        CHUNKS_PER_WORKER batches per worker (or 1 item, if data has no len())
+    :param rows: type of values passed to func for a pd.DataFrame input:
+        'series' (slow, a pd.Series per row, as .iterrows()), 'tuple'
+        (namedtuples, as .itertuples(); thread backend only) or 'dict'
+        (column: value)
+    :param progress: True to log completed, failed and in flight counts,
+        throughput, latency and ETA every progress.PROGRESS_INTERVAL
+        seconds; a path to also write them to this JSON status file.
+        Also accepts a progress.Progress instance
 
     >>> s = pd.Series(range(120, 0, -1))
     >>> s2 = map(lambda i, x: x ** 3.75, s)
@@ -33,37 +494,226 @@ def map(func, data, num_workers=None):
     True
     >>> all(x ** 3.75 == s2[i] for i, x in s.items())
     True
+    >>> s2, failed = map(lambda i, x: 1 // x, [1, 0], return_failed=True)
+    >>> s2[0], list(failed.keys())
+    (1, [1])
+    >>> map(lambda i, x: x ** 2, [1, 2, 3], backend='process')
+    [1, 4, 9]
+    >>> df = pd.DataFrame({'a': [1, 2], 'b': [3, 4]})
+    >>> map(lambda i, row: {'sum': row['a'] + row['b']}, df, rows='dict',
+    ...     batch_size=10)['sum'].tolist()
+    [4, 6]
     """
-    backend = threadpool.ThreadPool(n_workers=num_workers)
-    iterable = None
-    # pd.Series didn't have .items() until pandas 0.21,
-    # so iteritems for older versions
-    for method in ('iterrows', 'iteritems', 'items'):
-        if hasattr(data, method):
-            iterable = getattr(data, method)()
-            break
-    if iterable is None:
-        iterable = enumerate(data)
-
+    _check_args(backend, rows)
+    if checkpoint is not None:
+        checkpoint = Checkpoint(checkpoint, expires=checkpoint_expires)
+    done = checkpoint.load() if checkpoint else {}
     mapped = {}
+    failed = {}
+
+    def pending():
+        for key, value in _items(data, rows):
+            if key in done:
+                mapped[key] = done[key]
+            else:
+                yield key, value
 
-    def collect(key):
-        def process(res):
-            mapped[key] = res
-        return process
+    progress = _get_progress(progress, func, data, len(done))
+    try:
+        for key, value, error in _imap(
+                func, pending(), num_workers, False, QUEUE_SIZE, retries,
+                backoff, backend,
+                _batch_size(data, num_workers, batch_size, backend),
+                progress):
+            if error is not None:
+                failed[key] = error
+                continue
+            mapped[key] = value
+            if checkpoint:
+                checkpoint.add(key, value)
+    finally:
+        # on interrupt, keep the last incomplete batch for the next run
+        if checkpoint:
+            checkpoint.flush()
+        progress.close()
 
-    for key, value in iterable:
-        backend.submit(func, key, value, callback=collect(key))
+    if checkpoint:  # the run is complete, failed keys won't recover
+        checkpoint.remove()
+    if failed:
+        logger.warning("%d keys failed: %s", len(failed),
+                       ", ".join(str(key) for key in list(failed)[:10]))
 
-    backend.shutdown()
+    result = _assemble(data, mapped)
+    return (result, failed) if return_failed else result
 
+
+def imap(func, data, num_workers=None, ordered=False,
+         buffer_size=QUEUE_SIZE, retries=0, backoff=1, backend='thread',
+         batch_size=None, rows='series', progress=None):
+    """ Streaming version of map(): yield (key, result) as soon as ready
+
+    Unlike map(), results are not accumulated, so they can be written out
+    as they come at constant memory. Input can be any iterable, e.g. a
+    generator, and is consumed lazily.
+
+    :param ordered: yield results in the input order. Results completed
+        ahead of a slow item wait in the reorder buffer
+    :param buffer_size: max number of items being processed or waiting to
+        be yielded, including the reorder buffer. If the consumer is slow,
+        workers wait for it
+    :param retries, backoff, backend, batch_size, rows, progress: same as
+        in map().
+        Without len(data), process backend sends one item per batch
+    If a key fails after all retries, its exception is raised
+
+    >>> list(imap(lambda i, x: x ** 2, [1, 2, 3], ordered=True))
+    [(0, 1), (1, 4), (2, 9)]
+    >>> sorted(imap(lambda i, x: x ** 2, {'a': 1, 'b': 2}))
+    [('a', 1), ('b', 4)]
+    >>> list(imap(lambda i, x: x ** 2, [1, 2, 3], ordered=True,
+    ...           backend='process'))
+    [(0, 1), (1, 4), (2, 9)]
+    """
+    _check_args(backend, rows)
+    assert buffer_size > 0, "buffer_size has to be positive"
+    progress = _get_progress(progress, func, data)
+    try:
+        for key, value, error in _imap(
+                func, _items(data, rows), num_workers, ordered, buffer_size,
+                retries, backoff, backend,
+                _batch_size(data, num_workers, batch_size, backend),
+                progress):
+            if error is not None:
+                raise error
+            yield key, value
+    finally:  # also if the consumer stops early or fails
+        progress.close()
+
+
+def map_combine(func, combine, data, num_workers=None, retries=0, backoff=1,
+                return_failed=False, backend='thread', batch_size=None,
+                rows='series', progress=None):
+    """ Apply func(key, value) to every item of data in parallel and
+    aggregate results with combine(a, b) -> c, without holding them all
+
+    Results are combined inside workers as they finish: thread backend
+    keeps a partial result per thread, process backend per batch (by
+    default, CHUNKS_PER_WORKER batches per worker), asyncio backend has a
+    single one, since everything runs on one thread. Then partials are
+    combined pairwise in parallel (tree reduce). So, memory use depends on
+    number of workers rather than number of inputs.
+
+    combine has to be associative and commutative (e.g. sum, max, set
+    union or pd.DataFrame.add), since the order of results is arbitrary.
+    Returns None if there are no successful results.
+    Other arguments are the same as in map()
+
+    >>> import operator
+    >>> map_combine(lambda i, x: x ** 2, operator.add, range(100))
+    328350
+    >>> map_combine(lambda i, x: {x % 3}, operator.or_, range(100),
+    ...             backend='process') == {0, 1, 2}
+    True
+    >>> res, failed = map_combine(lambda i, x: 1 // x, max, [0, 1, 2],
+    ...                           return_failed=True)
+    >>> res, list(failed)
+    (1, [0])
+    """
+    _check_args(backend, rows)
+    progress = _get_progress(progress, func, data)
+    batch_size = _batch_size(data, num_workers, batch_size, backend)
+    batches = _chunks(_items(data, rows), batch_size)
+    max_batches = max(QUEUE_SIZE // batch_size, 1)
+    failed = {}
+
+    def record(elapsed, n, errors):
+        failed.update(errors)
+        progress.add(n, failed=len(errors), latency=elapsed / max(n, 1))
+
+    if backend == 'asyncio':
+        result = None
+        has_result = False
+        for key, value, error in _imap(func, _items(data, rows), num_workers,
+                                       False, QUEUE_SIZE, retries, backoff,
+                                       backend, batch_size, progress):
+            if error is not None:
+                failed[key] = error
+                continue
+            result = combine(result, value) if has_result else value
+            has_result = True
+    elif backend == 'thread':
+        accumulators = {}  # thread ident: partial result
+        errors = []  # exceptions raised by combine
+
+        def task(batch):
+            elapsed, n, failed_keys, (has_partial, partial) = \
+                _combine_chunk(func, combine, batch, retries, backoff)
+            if has_partial:  # no locking, only this thread uses this key
+                ident = threading.current_thread().ident
+                if ident in accumulators:
+                    partial = combine(accumulators[ident], partial)
+                accumulators[ident] = partial
+            return elapsed, n, failed_keys
+
+        def check(future):
+            if future.exception() is not None:
+                errors.append(future.exception())
+
+        pool = threadpool.ThreadPool(n_workers=num_workers,
+                                     queue_size=max_batches)
+        for batch in batches:
+            progress.submitted(len(batch))
+            future = pool.submit(task, batch,
+                                 callback=lambda res: record(*res))
+            future.add_done_callback(check)
+        pool.shutdown()
+        if errors:
+            raise errors[0]
+
+        pool = threadpool.ThreadPool(n_workers=num_workers)
+        partials = list(accumulators.values())
+        result = _tree_reduce(pool.map, combine, partials) \
+            if partials else None
+        pool.shutdown()
+    else:
+        partials = []
+
+        def tasks(func_ref, combine_ref):
+            for batch in batches:
+                progress.submitted(len(batch))
+                yield func_ref, combine_ref, batch, retries, backoff
+
+        with _process_pool(num_workers, func, combine) as (
+                pool, (func_ref, combine_ref)):
+            max_partials = 2 * (num_workers or threadpool.CPU_COUNT)
+            for elapsed, n, failed_keys, (has_partial, partial) in \
+                    _bounded_imap(pool, _process_combine_chunk,
+                                  tasks(func_ref, combine_ref), max_batches):
+                record(elapsed, n, failed_keys)
+                if has_partial:
+                    partials.append(partial)
+                if len(partials) >= max_partials:  # e.g. data has no len()
+                    partials = _combine_round(pool.map, combine_ref,
+                                              partials)
+            result = _tree_reduce(pool.map, combine_ref, partials) \
+                if partials else None
+
+    progress.close()
+    if failed:
+        logger.warning("%d keys failed: %s", len(failed),
+                       ", ".join(str(key) for key in list(failed)[:10]))
+    return (result, failed) if return_failed else result
+
+
+def _assemble(data, mapped):
+    """ Convert map results back into type of input data """
     if isinstance(data, pd.DataFrame):
         return pd.DataFrame.from_dict(
             mapped, orient='index').reindex(data.index)
     elif isinstance(data, pd.Series):
         return pd.Series(mapped).reindex(data.index)
     elif isinstance(data, list):
-        return [mapped[i] for i in range(len(data))]
+        return [mapped.get(i) for i in range(len(data))]
     else:
         # in Python, hash(<int>) := <int>, so guaranteed to be in order for list
         # and tuple. For other types
@@ -76,11 +726,15 @@ class MapReduce(object):
 
     Workflow:
         (input of every function passed to the next one)
-        preprocess -> map -> reduce -> postprocess
+        preprocess -> map -> [combine] -> reduce -> postprocess
 
         at least map() or reduce() should be defined.
         pre/post processing is intended for reusable classes, useless otherwise
 
+        If combine(a, b) is defined, map results are aggregated by it as
+        they come instead of being collected, see map_combine(). Then reduce
+        gets the combined result.
+
     Use:
         class Processor(MapRedue):
             # NOTE: all methods are static, i.e. no self
@@ -91,17 +745,23 @@ class MapReduce(object):
 
             def map(key, value)
                 # depending on input, key, value defined as a result of:
-                # .iterrows(), .items(), or enumerate, whatever found first
+                # .iterrows() (see rows), .items(), or enumerate,
+                # whatever found first
                 processed_value = process(value)
                 return key, processed_value
 
     """
     # change these to override default backend
-    n_workers = None  # keywords to init backend object (Threadpool)
+    n_workers = None  # number of workers, default depends on backend
+    backend = 'thread'  # {thread|process}, see map()
+    batch_size = None  # items per task, see map()
+    rows = 'series'  # {series|tuple|dict}, type of pd.DataFrame rows
+    progress = None  # True or JSON status file path to report progress
 
     # methods
     preprocess = None
     map = None
+    combine = None
     reduce = None
     postprocess = None
     @staticmethod
@@ -132,17 +792,25 @@ class MapReduce(object):
             - reduce will be used as a success callback to form result
         """
 
-        assert cls.map or cls.reduce, "MapReduce subclasses are expected to " \
-                                      "have at least one of map() or reduce()" \
-                                      " methods defined."
+        assert cls.map or cls.combine or cls.reduce, \
+            "MapReduce subclasses are expected to have at least one of " \
+            "map(), combine() or reduce() methods defined."
 
         if cls.preprocess:
             data = cls.preprocess(data)
 
-        assert isinstance(data, collections.Iterable), "Iterable expected"
+        assert isinstance(data, Iterable), "Iterable expected"
 
-        if cls.map:
-            data = map(cls.map, data)
+        if cls.combine:
+            data = map_combine(
+                cls.map or (lambda key, value: value), cls.combine, data,
+                num_workers=cls.n_workers, backend=cls.backend,
+                batch_size=cls.batch_size, rows=cls.rows,
+                progress=cls.progress)
+        elif cls.map:
+            data = map(cls.map, data, num_workers=cls.n_workers,
+                       backend=cls.backend, batch_size=cls.batch_size,
+                       rows=cls.rows, progress=cls.progress)
 
         if cls.reduce:
             data = cls.reduce(data)
@@ -0,0 +1,185 @@
+"""Progress, throughput and ETA of long running jobs.
+
+Workers report completed tasks to a Progress instance; every `interval`
+seconds it logs a summary line and, optionally, writes the same numbers to
+a JSON status file, which can be watched while the job runs:
+
+    watch cat package_urls.status.json
+
+    >>> p = Progress('test', total=10, interval=None)
+    >>> p.submitted(4)
+    >>> p.add(latency=0.5)
+    >>> p.add(2, failed=1, latency=1)
+    >>> s = p.snapshot()
+    >>> s['completed'], s['failed'], s['in_flight'], s['remaining']
+    (2, 1, 1, 7)
+"""
+
+import collections
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+# seconds between progress reports
+PROGRESS_INTERVAL = 60
+# sliding windows of throughput, seconds
+RATE_WINDOWS = (60, 300, 900)
+# number of most recent task latencies used for percentiles
+LATENCY_SAMPLES = 1000
+LATENCY_PERCENTILES = (50, 90, 99)
+
+logger = logging.getLogger("ghd.progress")
+
+
+def _percentile(sorted_values, p):
+    """ Nearest rank percentile of a sorted list
+    >>> _percentile([1, 2, 3, 4], 50)
+    2
+    """
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(sorted_values))) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+def format_duration(seconds):
+    """
+    >>> format_duration(93784)
+    '1d 02:03:04'
+    >>> format_duration(None)
+    '?'
+    """
+    if seconds is None:
+        return '?'
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 86400)
+    res = "%02d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60,
+                              seconds % 60)
+    return "%dd %s" % (days, res) if days else res
+
+
+class Progress(object):
+    """ Thread-safe counters of a job: completed, failed and in flight
+    (submitted, but not finished yet) tasks, throughput over sliding
+    windows, task latency percentiles and ETA (if total is known)
+
+    :param name: job name used in logs
+    :param total: expected number of tasks, if known
+    :param interval: seconds between reports, None to only collect numbers
+    :param status_file: path to JSON file updated on every report
+    """
+    def __init__(self, name, total=None, interval=PROGRESS_INTERVAL,
+                 status_file=None):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.status_file = status_file
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.started = time.time()
+        # (second, number of tasks finished in that second)
+        self._buckets = collections.deque()
+        self._latencies = collections.deque(maxlen=LATENCY_SAMPLES)
+        self._last_report = self.started
+        self._lock = threading.Lock()
+
+    def submitted(self, n=1):
+        with self._lock:
+            self.in_flight += n
+
+    def discard(self, n=1):
+        """ Record n submitted tasks that won't run, e.g. cancelled """
+        with self._lock:
+            self.in_flight = max(self.in_flight - n, 0)
+
+    def add(self, n=1, failed=0, latency=None):
+        """ Record n finished tasks, of them `failed` unsuccessfully
+        :param latency: duration of a single task in seconds
+        """
+        now = time.time()
+        with self._lock:
+            self.completed += n - failed
+            self.failed += failed
+            self.in_flight = max(self.in_flight - n, 0)
+            second = int(now)
+            if self._buckets and self._buckets[-1][0] == second:
+                self._buckets[-1][1] += n
+            else:
+                self._buckets.append([second, n])
+                while self._buckets[0][0] <= second - max(RATE_WINDOWS):
+                    self._buckets.popleft()
+            if latency is not None:
+                self._latencies.append(latency)
+            report = self.interval is not None \
+                and now - self._last_report >= self.interval
+            if report:  # only one thread reports
+                self._last_report = now
+        if report:
+            self.report()
+
+    def snapshot(self):
+        # type: () -> dict
+        now = time.time()
+        with self._lock:
+            buckets = list(self._buckets)
+            latencies = sorted(self._latencies)
+            res = {
+                'name': self.name,
+                'total': self.total,
+                'completed': self.completed,
+                'failed': self.failed,
+                'in_flight': self.in_flight,
+            }
+        elapsed = now - self.started
+        res['elapsed'] = elapsed
+        res['rate'] = {}
+        for window in RATE_WINDOWS:
+            count = sum(n for second, n in buckets if second > now - window)
+            res['rate']['%dm' % (window // 60)] = \
+                count / max(min(window, elapsed), 1.0)
+        res['latency'] = {'p%d' % p: _percentile(latencies, p)
+                          for p in LATENCY_PERCENTILES}
+        res['remaining'] = res['eta'] = None
+        if self.total is not None:
+            res['remaining'] = max(
+                self.total - res['completed'] - res['failed'], 0)
+            # 5 minutes window is recent enough, but not too noisy
+            rate = res['rate']['5m']
+            if rate:
+                res['eta'] = res['remaining'] / rate
+        res['updated'] = now
+        return res
+
+    def report(self):
+        """ Log current progress and update the status file """
+        s = self.snapshot()
+        done = s['completed'] + s['failed']
+        windows = ['%dm' % (window // 60) for window in RATE_WINDOWS]
+        latency = " ".join(
+            "%s %.2fs" % (p, s['latency'][p]) for p in sorted(s['latency'])
+            if s['latency'][p] is not None)
+        logger.info(
+            "%s: %d%s done (%d failed, %d in flight), %s items/s (%s), %s, "
+            "elapsed %s, ETA %s", self.name, done,
+            "" if self.total is None else "/%d" % self.total,
+            s['failed'], s['in_flight'],
+            "/".join("%.1f" % s['rate'][w] for w in windows),
+            "/".join(windows), latency or "no latency data",
+            format_duration(s['elapsed']), format_duration(s['eta']))
+
+        if self.status_file:
+            # written to a temp file and renamed, so readers never see
+            # a partially written status
+            tmp_fpath = "%s.%d.tmp" % (self.status_file, os.getpid())
+            with open(tmp_fpath, 'w') as fh:
+                json.dump(s, fh, indent=2, sort_keys=True)
+            os.rename(tmp_fpath, self.status_file)
+
+    def close(self):
+        """ Final report, if reporting is enabled """
+        if self.interval is not None:
+            self.report()
@@ -1,15 +1,27 @@
 
 from __future__ import unicode_literals, print_function
 
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 import random
 
 import numpy as np
 import pandas as pd
+import requests
 
 from common import decorators as d
+from common import graph
 from common import mapreduce
+from common import progress
 from common import threadpool
+from common import throttle
+from common import versions
 
 
 def series(length):
@@ -20,6 +32,41 @@ def dataframe(x, y):
     return pd.DataFrame(np.random.rand(x, y) * 100).astype(int)
 
 
+def typed_dataframe(*_):
+    return pd.DataFrame({
+        'author': ['john', '', None],
+        'commits': [1, 2, 3],
+        'share': [0.1, 0.25, 1.0 / 3],
+    }, index=pd.MultiIndex.from_tuples(
+        [('2017-01', 'a'), ('2017-01', 'b'), ('2017-02', 'a')],
+        names=['month', 'user']))
+
+
+# dataset folder of tests, instead of DATASET_PATH in the source tree
+_ds_path = None
+
+
+def setUpModule():
+    global _ds_path
+    _ds_path = tempfile.mkdtemp()
+    # counters are flushed to the manifest of this folder
+    d.cache_stats.flush()
+    d.cache_stats.ds_path = _ds_path
+
+
+def tearDownModule():
+    d.cache_stats.flush()
+    shutil.rmtree(_ds_path)
+
+
+def _has_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        return False
+    return True
+
+
 class TestDecorators(unittest.TestCase):
     @d.cached_method
     def rand(self, *args):
@@ -36,12 +83,61 @@ class TestDecorators(unittest.TestCase):
         self.assertEquals(mtest('one', 'two'), mtest('one', 'two'))
         self.assertNotEquals(mtest('one', 'two'), mtest('two', 'one'))
 
+    def test_memoize_single_flight(self):
+        calls = []
+
+        @d.memoize
+        def slow(x):
+            calls.append(x)
+            time.sleep(0.1)
+            return x * 2
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(slow(21)))
+                   for _ in range(8)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertEqual(calls, [21])
+        self.assertEqual(results, [42] * 8)
+
+    def test_memoize_interrupted(self):
+        store = d.MemoStore()
+
+        def interrupted():
+            raise KeyboardInterrupt
+
+        self.assertRaises(KeyboardInterrupt, store.get, 'key', interrupted)
+        # would wait forever for the interrupted computation
+        self.assertEqual(store.get('key', lambda: 42), 42)
+
+    def test_memoize_bounds(self):
+        @d.memoize(maxsize=2, ttl=0.1)
+        def test(*args):
+            return random.random()
+
+        first = test('one')
+        test('two')
+        test('three')  # evicts 'one'
+        self.assertEqual(test.cache_info().currsize, 2)
+        self.assertNotEqual(first, test('one'))
+
+        second = test('two')
+        self.assertEqual(second, test('two'))
+        time.sleep(0.15)
+        self.assertNotEqual(second, test('two'))
+
+        test.cache_clear()
+        self.assertEqual(test.cache_info(), (0, 0, 2, 0))
+
+        # unhashable arguments still work
+        self.assertEqual(test(['a']), test(['a']))
+
     def test_cached_method(self):
         self.assertEquals(self.rand('one', 'two'), self.rand('one', 'two'))
         self.assertNotEquals(self.rand('one', 'two'), self.rand('two', 'one'))
 
     def test_fs_cache(self):
-        decorator = d.fs_cache('common')
+        decorator = d.fs_cache('common', ds_path=_ds_path)
         cseries = decorator(series)
         self.assertEqual(0, (cseries(10) != cseries(10)).values.sum())
         self.assertGreater((cseries(10, 'one', 'two') != cseries(10, 'two', 'one')).values.sum(), 0)
@@ -58,6 +154,404 @@ class TestDecorators(unittest.TestCase):
 
         decorator.invalidate(cdataframe)
 
+    def test_fs_cache_serializers(self):
+        serializers = ['pickle']
+        if _has_pyarrow():
+            serializers.extend(['parquet', 'feather'])
+        ds_path = tempfile.mkdtemp()
+        try:
+            for serializer in serializers:
+                decorator = d.fs_cache(
+                    'test', idx=2, ds_path=ds_path, serializer=serializer)
+                cached = decorator(typed_dataframe)
+                cached(serializer)  # populate cache
+                df = cached(serializer)  # read from cache
+                pd.testing.assert_frame_equal(df, typed_dataframe())
+
+                decorator = d.fs_cache(
+                    'test', ds_path=ds_path, serializer=serializer)
+                cached = decorator(series)
+                cseries = cached(10)
+                pd.testing.assert_series_equal(
+                    cseries, cached(10), check_names=False)
+
+            if _has_pyarrow():
+                # computed and loaded results have the same column labels
+                cached = d.fs_cache('test', ds_path=ds_path,
+                                    serializer='parquet')(dataframe)
+                self.assertEqual(cached(3, 3).columns.tolist(), [0, 1, 2])
+                self.assertEqual(cached(3, 3).columns.tolist(), [0, 1, 2])
+        finally:
+            shutil.rmtree(ds_path)
+
+    def test_fs_cache_matrix(self):
+        ds_path = tempfile.mkdtemp()
+        try:
+            decorator = d.fs_cache('test', ds_path=ds_path, serializer='mtx')
+            cached = decorator(dataframe)
+            df = cached(10, 12)
+            df.columns = ['2017-%02d' % (i + 1) for i in range(12)]
+            self.assertTrue((cached(10, 12).values == df.values).all())
+
+            fpath = os.path.join(ds_path, 'floats.mtx')
+            decorator.serializer.dump(df / 3.0, fpath)
+            res = decorator.serializer.load(fpath, 1)
+            self.assertEqual(res.values.dtype, np.float32)
+            self.assertFalse(res.values.flags.writeable)  # memory mapped
+            self.assertEqual(res.loc[:, :'2017-06'].shape, (10, 6))
+            self.assertTrue(np.allclose(res.values, df.values / 3.0))
+            # columns are contiguous in the file
+            self.assertTrue(res.values.flags.f_contiguous)
+
+            # integers not fitting into int32
+            decorator.serializer.dump(df * 2 ** 40, fpath)
+            res = decorator.serializer.load(fpath, 1)
+            self.assertEqual(res.values.dtype, np.int64)
+            self.assertTrue((res.values == df.values * 2 ** 40).all())
+        finally:
+            shutil.rmtree(ds_path)
+
+    def test_fs_cache_memory(self):
+        ds_path = tempfile.mkdtemp()
+        try:
+            decorator = d.fs_cache('test', ds_path=ds_path, memory=10 ** 6)
+            cached = decorator(series)
+            s = cached(10)
+            s[:] = -1  # returned values can be modified safely
+            self.assertTrue((cached(10) >= 0).all())
+            info = decorator.memory.cache_info()
+            self.assertEqual((info.hits, info.misses, info.entries), (1, 1, 1))
+            self.assertGreater(info.nbytes, 0)
+
+            decorator.invalidate(series)
+            self.assertEqual(decorator.memory.cache_info().entries, 0)
+        finally:
+            shutil.rmtree(ds_path)
+
+    def test_fs_cache_manifest(self):
+        ds_path = tempfile.mkdtemp()
+        try:
+            decorator = d.fs_cache('test', ds_path=ds_path)
+            cached = decorator(series)
+            s = cached(10)
+            fpath = decorator.get_cache_fname('series', 10)
+            entry = decorator.manifest.lookup(fpath)
+            self.assertEqual(entry.func, 'series')
+            self.assertEqual(entry.size, os.path.getsize(fpath))
+            self.assertFalse(decorator.expired(fpath))
+
+            # file removed behind manifest's back is recomputed
+            os.remove(fpath)
+            self.assertEqual(len(cached(10)), len(s))
+            self.assertTrue(os.path.isfile(fpath))
+
+            decorator.invalidate(series)
+            self.assertFalse(os.path.isfile(fpath))
+            self.assertIsNone(decorator.manifest.lookup(fpath))
+        finally:
+            shutil.rmtree(ds_path)
+
+    def test_fs_cache_lazy_scan(self):
+        ds_path = tempfile.mkdtemp()
+        try:
+            # a file created before the manifest
+            cache_path = d.mkdir(ds_path, "test.cache")
+            fpath = os.path.join(cache_path, "series.10.csv")
+            series(10).to_csv(fpath)
+            decorator = d.fs_cache('test', ds_path=ds_path)
+            self.assertFalse(decorator.manifest.cache_paths())  # not scanned
+            self.assertFalse(decorator.manifest.wal)
+            self.assertFalse(decorator.expired(fpath))  # found on disk
+
+            decorator.invalidate(series)
+            self.assertFalse(os.path.isfile(fpath))
+            self.assertEqual(decorator.manifest.cache_paths(),
+                             [decorator.cache_path])
+        finally:
+            shutil.rmtree(ds_path)
+
+    def test_fs_cache_hashed_keys(self):
+        ds_path = tempfile.mkdtemp()
+        try:
+            decorator = d.fs_cache('test', ds_path=ds_path,
+                                   key_scheme='hashed')
+
+            def echo(*args):
+                return pd.Series(args)
+
+            cached = decorator(echo)
+            self.assertEqual(cached('a/b').iloc[0], 'a/b')
+            self.assertEqual(cached('a.b').iloc[0], 'a.b')  # no collision
+            long_arg = 'github.com/' + 'x' * 500
+            self.assertEqual(cached(long_arg).iloc[0], long_arg)
+            self.assertEqual(cached('a/b').iloc[0], 'a/b')  # from cache
+
+            entries = decorator.manifest.entries(decorator.cache_path, 'echo')
+            self.assertEqual(len(entries), 3)
+            for entry in entries:  # sharded by hash prefix
+                shard = os.path.basename(os.path.dirname(entry.path))
+                self.assertEqual(len(shard), 2)
+
+            # new version doesn't reuse old results
+            calls = []
+
+            @d.cache_version(2)
+            def echo(*args):
+                calls.append(args)
+                return pd.Series(args)
+
+            cached = decorator(echo)
+            cached('a/b')
+            self.assertEqual(len(calls), 1)
+
+            decorator.invalidate(echo)
+            self.assertFalse(
+                decorator.manifest.entries(decorator.cache_path, 'echo'))
+
+            # rescan finds sharded files
+            cached('a/b')
+            decorator.manifest.scan(decorator.cache_path, force=True)
+            self.assertEqual(len(
+                decorator.manifest.entries(decorator.cache_path, 'echo')), 1)
+        finally:
+            shutil.rmtree(ds_path)
+
+    def test_fs_cache_stale_while_revalidate(self):
+        ds_path = tempfile.mkdtemp()
+        try:
+            decorator = d.fs_cache('test', ds_path=ds_path, expires=0.3,
+                                   max_stale=1)
+            calls = []
+
+            def slow_series(length):
+                calls.append(length)
+                if len(calls) > 1:  # refresh
+                    time.sleep(0.2)
+                return series(length)
+
+            cached = decorator(slow_series)
+            s = cached(10)
+            time.sleep(0.35)  # expired, but within max_stale
+            start = time.time()
+            stale = cached(10)
+            self.assertLess(time.time() - start, 0.1)  # didn't wait
+            self.assertTrue((stale.values == s.values).all())
+
+            time.sleep(0.35)  # refreshed in background by now
+            self.assertEqual(len(calls), 2)
+            self.assertFalse(decorator.expired(
+                decorator.get_cache_fname('slow_series', 10)))
+
+            time.sleep(1.5)  # too stale, recomputed synchronously
+            cached(10)
+            self.assertEqual(len(calls), 3)
+        finally:
+            shutil.rmtree(ds_path)
+
+    def test_fs_cache_memory_stale(self):
+        ds_path = tempfile.mkdtemp()
+        try:
+            memory = d.MemoryCache(10 ** 6)
+            decorator = d.fs_cache('test', ds_path=ds_path, expires=0.3,
+                                   max_stale=1, memory=memory)
+            calls = []
+
+            def counted_series(length):
+                calls.append(length)
+                return series(length)
+
+            cached = decorator(counted_series)
+            cached(10)
+            time.sleep(0.35)  # expired, but within max_stale
+            cached(10)
+            # stale value is served by a single lookup
+            info = memory.cache_info()
+            self.assertEqual((info.hits, info.misses), (1, 1))
+            time.sleep(0.2)  # refreshed in background by now
+            self.assertEqual(len(calls), 2)
+        finally:
+            shutil.rmtree(ds_path)
+
+    def test_fs_cache_compression(self):
+        compressions = ['gzip']
+        if d.zstd is not None:
+            compressions.append('zstd')
+        calls = []
+
+        def stats():
+            calls.append(1)
+            return pd.DataFrame({'commits': [1, 2, 3],
+                                 'share': [0.1, 0.25, 0.5]})
+
+        ds_path = tempfile.mkdtemp()
+        try:
+            for serializer in ('csv', 'pickle'):
+                for compression in compressions:
+                    decorator = d.fs_cache(
+                        'test', ds_path=ds_path, cache_type=compression,
+                        serializer=serializer, compression=compression)
+                    res = decorator(stats)()
+                    fpath = decorator.get_cache_fname('stats')
+                    self.assertTrue(fpath.endswith(
+                        d.COMPRESSION_EXTENSIONS[compression]))
+                    loaded = decorator.load(fpath)
+                    self.assertTrue((loaded.values == res.values).all())
+
+                # existing uncompressed entries are migrated, not recomputed
+                plain = d.fs_cache('test', ds_path=ds_path,
+                                   serializer=serializer)
+                plain(stats)()
+                del calls[:]
+                decorator = d.fs_cache('test', ds_path=ds_path,
+                                       serializer=serializer,
+                                       compression='gzip')
+                decorator(stats)()
+                self.assertFalse(calls)
+                self.assertFalse(os.path.isfile(
+                    plain.get_cache_fname('stats')))
+                self.assertTrue(os.path.isfile(
+                    decorator.get_cache_fname('stats')))
+
+                # uncompressed copy is removed when the entry is recomputed
+                plain(stats)()
+                expired = d.fs_cache('test', ds_path=ds_path,
+                                     serializer=serializer,
+                                     compression='gzip', expires=-1)
+                expired(stats)()
+                self.assertFalse(os.path.isfile(
+                    plain.get_cache_fname('stats')))
+                self.assertIsNone(plain.manifest.lookup(
+                    plain.get_cache_fname('stats')))
+        finally:
+            shutil.rmtree(ds_path)
+
+    def test_cache_stats(self):
+        @d.memoize
+        def probe(x):
+            return x
+
+        probe(1)
+        probe(1)
+        ds_path = tempfile.mkdtemp()
+        try:
+            decorator = d.fs_cache('test', ds_path=ds_path)
+            cached = decorator(series)
+            cached(10)
+            cached(10)
+            stats = d.cache_stats.snapshot()
+            memo = stats.loc[('memoize', 'common.test.probe')]
+            self.assertEqual((memo['hits'], memo['misses']), (1, 1))
+            fs = stats.loc[('fs_cache', 'common.test.series')]
+            self.assertGreaterEqual(fs['hits'], 1)
+            self.assertGreater(fs['bytes_written'], 0)
+            self.assertGreater(fs['bytes_read'], 0)
+        finally:
+            shutil.rmtree(ds_path)
+
+    def test_memory_cache_eviction(self):
+        s = series(1000)
+        mc = d.MemoryCache(int(d._nbytes(s) * 2.5))
+        for key in ('one', 'two', 'three'):
+            mc.put(key, s)
+        self.assertIsNone(mc.get('one'))  # least recently used
+        self.assertIsNotNone(mc.get('three'))
+        self.assertLessEqual(mc.nbytes, mc.max_bytes)
+
+    def test_memory_cache_copy(self):
+        s = series(100)
+        mc = d.MemoryCache(10 ** 6)
+        mc.put('key', s, nbytes=1000)
+        self.assertEqual(mc.nbytes, 1000)  # size is not estimated again
+        self.assertIsNot(mc.get('key'), mc.get('key'))
+
+        shared = d.MemoryCache(10 ** 6, copy=False)
+        shared.put('key', s)
+        self.assertIs(shared.get('key'), s)
+
+    def test_fs_cache_single_flight(self):
+        calls = []
+
+        def slow_series(length):
+            calls.append(length)
+            time.sleep(0.2)
+            return series(length)
+
+        ds_path = tempfile.mkdtemp()
+        try:
+            decorator = d.fs_cache('test', ds_path=ds_path)
+            cached = decorator(slow_series)
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(
+                cached(10))) for _ in range(4)]
+            [t.start() for t in threads]
+            [t.join() for t in threads]
+
+            self.assertEqual(len(calls), 1)
+            self.assertEqual(len(results), 4)
+            for res in results:
+                self.assertTrue((res.values == results[0].values).all())
+            # no temp files left behind; no lock files per entry either,
+            # they are shared by all entries of the dataset
+            fnames = os.listdir(decorator.cache_path)
+            self.assertFalse([fname for fname in fnames
+                              if fname.endswith((".tmp", ".lock"))])
+            self.assertEqual(os.listdir(decorator.locks_path), [
+                os.path.basename(d.stripe_lock_fname(
+                    decorator.locks_path, decorator.get_cache_fname(
+                        slow_series.__name__, 10)))])
+        finally:
+            shutil.rmtree(ds_path)
+
+    def test_stripe_lock(self):
+        ds_path = tempfile.mkdtemp()
+        try:
+            # same stripe, e.g. a cached function calling another one
+            with d.stripe_lock(ds_path, "one") as locked:
+                self.assertTrue(locked)
+                with d.stripe_lock(ds_path, "one") as locked:
+                    self.assertTrue(locked)
+            # a busy stripe is skipped by a thread holding another one
+            keys = ["key%d" % i for i in range(d.LOCK_STRIPES + 1)]
+            stripes = {}
+            for key in keys:
+                stripes.setdefault(d.stripe_lock_fname(ds_path, key), key)
+            key1, key2 = list(stripes.values())[:2]
+            acquired = threading.Event()
+            release = threading.Event()
+
+            def hold():
+                with d.stripe_lock(ds_path, key2):
+                    acquired.set()
+                    release.wait()
+
+            thread = threading.Thread(target=hold)
+            thread.start()
+            acquired.wait()
+            try:
+                with d.stripe_lock(ds_path, key1):
+                    with d.stripe_lock(ds_path, key2) as locked:
+                        self.assertFalse(locked)
+            finally:
+                release.set()
+                thread.join()
+        finally:
+            shutil.rmtree(ds_path)
+
+    def test_file_lock_removal(self):
+        ds_path = tempfile.mkdtemp()
+        lock_fpath = os.path.join(ds_path, "entry.lock")
+        try:
+            with d.file_lock(lock_fpath):
+                # held locks are not removed
+                self.assertFalse(d.remove_lock_file(lock_fpath))
+            self.assertTrue(d.remove_lock_file(lock_fpath))
+            self.assertFalse(os.path.exists(lock_fpath))
+            # removed lock files are recreated
+            with d.file_lock(lock_fpath):
+                self.assertTrue(os.path.isfile(lock_fpath))
+        finally:
+            shutil.rmtree(ds_path)
+
 
 class TestThreadpool(unittest.TestCase):
 
@@ -81,6 +575,558 @@ class TestThreadpool(unittest.TestCase):
         self.assertEqual(len(response), len(results))
         self.assertEqual(sum(response), sum(results))
 
+    def test_futures(self):
+        tp = threadpool.ThreadPool(4)
+        futures = [tp.submit(pow, x, 2) for x in range(100)]
+        self.assertEqual([f.result() for f in futures],
+                         [x ** 2 for x in range(100)])
+        self.assertEqual(
+            sorted(f.result() for f in threadpool.as_completed(futures)),
+            [x ** 2 for x in range(100)])
+        self.assertEqual(list(tp.map(pow, range(5), [2] * 5)), [0, 1, 4, 9, 16])
+
+        failed = tp.submit(int, 'not a number')
+        self.assertIsInstance(failed.exception(), ValueError)
+        self.assertRaises(ValueError, failed.result)
+
+        slow = tp.submit(time.sleep, 0.5)
+        self.assertRaises(threadpool.TimeoutError, slow.result, 0.01)
+        tp.shutdown()
+        self.assertTrue(slow.done())
+
+        # tasks waiting in the queue can be cancelled
+        tp = threadpool.ThreadPool(1)
+        tp.submit(time.sleep, 0.2)
+        pending = tp.submit(pow, 2, 2)
+        self.assertTrue(pending.cancel())
+        self.assertRaises(threadpool.CancelledError, pending.result)
+        tp.shutdown()
+
+        # no polling delay for short tasks
+        tp = threadpool.ThreadPool(4)
+        start = time.time()
+        for x in range(1000):
+            tp.submit(pow, x, 2)
+        tp.shutdown()
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_concurrent_callbacks(self):
+        # callbacks don't wait for each other: each of them waits until
+        # both are running
+        lock = threading.Lock()
+        arrived = []
+        both_running = threading.Event()
+        waited = []
+
+        def callback(result):
+            with lock:
+                arrived.append(result)
+                if len(arrived) == 2:
+                    both_running.set()
+            waited.append(both_running.wait(5))
+
+        tp = threadpool.ThreadPool(2)
+        tp.submit(pow, 2, 2, callback=callback)
+        tp.submit(pow, 3, 2, callback=callback)
+        tp.shutdown()
+        self.assertEqual(sorted(arrived), [4, 9])
+        self.assertEqual(waited, [True, True])
+
+    def test_locked_callbacks(self):
+        lock = threading.Lock()
+        entered = []
+        first, second = threading.Event(), threading.Event()
+        release = threading.Event()
+
+        def callback(result):
+            with lock:
+                entered.append(result)
+                (second if len(entered) == 2 else first).set()
+            release.wait(5)
+
+        tp = threadpool.ThreadPool(2, lock_callbacks=True)
+        try:
+            tp.submit(pow, 2, 2, callback=callback)
+            tp.submit(pow, 3, 2, callback=callback)
+            self.assertTrue(first.wait(5))
+            # the second callback waits for the first one to return
+            self.assertFalse(second.wait(0.2))
+        finally:
+            release.set()
+        tp.shutdown()
+        self.assertEqual(sorted(entered), [4, 9])
+
+    def test_bounded_queue(self):
+        release = threading.Event()
+        started = [threading.Event(), threading.Event()]
+        submitted = threading.Event()
+
+        def block(i=None):
+            if i is not None:
+                started[i].set()
+            release.wait()
+
+        tp = threadpool.ThreadPool(2, queue_size=3)
+        try:
+            for i in range(2):  # occupy both workers
+                tp.submit(block, i)
+            for event in started:
+                self.assertTrue(event.wait(5))
+            for _ in range(3):  # fill the queue
+                tp.submit(block)
+            self.assertEqual(tp.queue.qsize(), 3)
+
+            def produce():
+                tp.submit(block)
+                submitted.set()
+
+            producer = threading.Thread(target=produce)
+            producer.start()
+            # bounded queue blocks the producer instead of growing
+            self.assertFalse(submitted.wait(0.2))
+            self.assertEqual(tp.queue.qsize(), 3)
+        finally:
+            release.set()
+        self.assertTrue(submitted.wait(5))
+        producer.join()
+        tp.shutdown()
+
+
+class TestMapReduce(unittest.TestCase):
+
+    def test_checkpoint(self):
+        tmpdir = tempfile.mkdtemp()
+        checkpoint = os.path.join(tmpdir, 'map.checkpoint')
+        calls = []
+        attempts = {}
+
+        def flaky(key, value):
+            calls.append(key)
+            attempts[key] = attempts.get(key, 0) + 1
+            if value == 3 and attempts[key] < 2:
+                raise IOError("Temporary failure")  # retried
+            if value == 5:
+                raise ValueError("Permanent failure")
+            return value * 2
+
+        try:
+            data = pd.Series(range(10))
+            res, failed = mapreduce.map(
+                flaky, data, checkpoint=checkpoint, retries=1, backoff=0,
+                return_failed=True)
+            self.assertEqual(list(failed.keys()), [5])
+            self.assertTrue(pd.isnull(res[5]))
+            self.assertEqual(res[3], 6)
+            # the run is complete despite the failure, so the next one
+            # recomputes everything
+            self.assertFalse(os.path.isfile(checkpoint))
+            del calls[:]
+            mapreduce.map(flaky, data, checkpoint=checkpoint, backoff=0)
+            self.assertEqual(sorted(set(calls)), list(range(10)))
+            self.assertFalse(os.path.isfile(checkpoint))
+
+            # interrupted run is resumed
+            cp = mapreduce.Checkpoint(checkpoint)
+            for key in range(9):
+                cp.add(key, key * 2)
+            cp.flush()
+            del calls[:]
+
+            def double(key, value):
+                calls.append(key)
+                return value * 2
+
+            res = mapreduce.map(double, data, checkpoint=checkpoint)
+            self.assertEqual(list(res), [x * 2 for x in range(10)])
+            self.assertEqual(calls, [9])
+            self.assertFalse(os.path.isfile(checkpoint))
+
+            # results of an interrupted run are flushed
+            class Interrupted(progress.Progress):
+                closed = False
+
+                def add(self, n=1, failed=0, latency=None):
+                    if self.completed >= 3:
+                        raise KeyboardInterrupt
+                    super(Interrupted, self).add(n, failed, latency)
+
+                def close(self):
+                    self.closed = True
+
+            interrupted = Interrupted('double', interval=None)
+            self.assertRaises(
+                KeyboardInterrupt, mapreduce.map, double, data,
+                num_workers=1, checkpoint=checkpoint, batch_size=1,
+                progress=interrupted)
+            self.assertTrue(interrupted.closed)
+            self.assertEqual(mapreduce.Checkpoint(checkpoint).load(),
+                             {0: 0, 1: 2, 2: 4})
+            os.remove(checkpoint)
+
+            # expired results are recomputed
+            cp.add(0, 0)
+            cp.flush()
+            del calls[:]
+            mapreduce.map(double, data, checkpoint=checkpoint,
+                          checkpoint_expires=-1)
+            self.assertEqual(sorted(calls), list(range(10)))
+
+            # truncated batch is discarded
+            cp = mapreduce.Checkpoint(checkpoint, batch_size=2)
+            for key in range(4):
+                cp.add(key, key)
+            with open(checkpoint, 'r+b') as fh:
+                fh.truncate(os.path.getsize(checkpoint) - 3)
+            self.assertEqual(cp.load(), {0: 0, 1: 1})
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_process_backend(self):
+        offset = 10  # closures work with forked workers
+
+        def add(key, value):
+            if value == 7:
+                raise ValueError("Permanent failure")
+            return value + offset
+
+        data = pd.Series(range(50))
+        res, failed = mapreduce.map(add, data, backend='process',
+                                    num_workers=2, return_failed=True)
+        self.assertEqual(list(failed.keys()), [7])
+        self.assertIsInstance(failed[7], ValueError)
+        self.assertEqual(res.drop(7).tolist(),
+                         [x + offset for x in range(50) if x != 7])
+
+    def test_process_backend_without_fork(self):
+        fork_context = mapreduce._fork_context
+        mapreduce._fork_context = lambda: None
+        offset = 10
+        try:
+            # closures can't be sent to spawned workers, threads are used
+            self.assertEqual(
+                mapreduce.map(lambda key, value: value + offset, [1, 2],
+                              backend='process'), [11, 12])
+            # picklable functions are sent as is
+            self.assertEqual(mapreduce.map(pow, [2, 3], backend='process'),
+                             [0, 1])
+        finally:
+            mapreduce._fork_context = fork_context
+
+    def test_imap(self):
+        started = []
+
+        def slow_first(key, value):
+            started.append(key)
+            if key == 0:
+                time.sleep(0.2)
+            return value * 2
+
+        def items():  # generator input is consumed lazily
+            for i in range(20):
+                yield i
+
+        # ordered: the slow first item doesn't let the rest run ahead
+        # further than the reorder buffer
+        results = mapreduce.imap(slow_first, items(), num_workers=4,
+                                 ordered=True, buffer_size=5)
+        self.assertEqual(next(results), (0, 0))
+        self.assertLessEqual(len(started), 5)
+        self.assertEqual(list(results), [(i, i * 2) for i in range(1, 20)])
+
+        # unordered: fast items are yielded before the slow one
+        del started[:]
+        keys = [key for key, _ in mapreduce.imap(
+            slow_first, range(20), num_workers=4, buffer_size=5)]
+        self.assertEqual(sorted(keys), list(range(20)))
+        self.assertNotEqual(keys[0], 0)
+
+        def fail(key, value):
+            raise ValueError("Permanent failure")
+
+        with self.assertRaises(ValueError):
+            list(mapreduce.imap(fail, range(3), backoff=0))
+
+        results = mapreduce.imap(lambda key, value: value + 1, range(1000),
+                                 ordered=True, backend='process',
+                                 num_workers=2, batch_size=10, buffer_size=50)
+        self.assertEqual(next(results), (0, 1))
+        results.close()  # stops the pool
+
+    def test_batches(self):
+        df = pd.DataFrame({'login': ['a', 'b', 'c'], 'repos': [1, 2, 3]},
+                          index=['x', 'y', 'z'])
+        for rows in ('series', 'tuple', 'dict'):
+            def get(key, row):
+                if rows == 'tuple':
+                    return {'user': row.login * row.repos}
+                return {'user': row['login'] * row['repos']}
+
+            res = mapreduce.map(get, df, rows=rows, batch_size=2)
+            self.assertEqual(res['user'].tolist(), ['a', 'bb', 'ccc'])
+            self.assertEqual(res.index.tolist(), ['x', 'y', 'z'])
+
+        data = list(range(1000))
+        res, failed = mapreduce.map(lambda i, x: 1 // (x % 500), data,
+                                    batch_size=64, return_failed=True)
+        self.assertEqual(sorted(failed), [0, 500])  # per item, not batch
+        self.assertEqual(res[1], 1)
+
+    def test_combine(self):
+        data = pd.DataFrame({'month': ['2017-01', '2017-02'] * 50,
+                             'commits': range(100)})
+        expected = data.groupby('month')['commits'].sum()
+
+        def commits(key, row):
+            return pd.Series({row['month']: row['commits']})
+
+        def add(a, b):
+            return a.add(b, fill_value=0)
+
+        for backend in ('thread', 'process'):
+            res = mapreduce.map_combine(commits, add, data, rows='dict',
+                                        backend=backend, num_workers=3)
+            self.assertEqual(res.to_dict(), expected.to_dict())
+
+        # partials are combined pairwise
+        self.assertEqual(mapreduce._tree_reduce(
+            lambda f, args: [f(a) for a in args], lambda a, b: a + b,
+            [[i] for i in range(5)]), list(range(5)))
+
+        class Total(mapreduce.MapReduce):
+            backend = 'process'
+            map = staticmethod(lambda key, value: value * 2)
+            combine = staticmethod(lambda a, b: a + b)
+            reduce = staticmethod(lambda total: total + 1)
+
+        self.assertEqual(Total(range(10)), 91)
+        self.assertIsNone(mapreduce.map_combine(
+            lambda key, value: value, max, []))
+
+    @unittest.skipIf(mapreduce.aio is None, "asyncio requires Python 3.5+")
+    def test_asyncio_backend(self):
+        import asyncio
+
+        # coroutines are defined via exec(), the syntax is invalid in Python 2
+        namespace = {'asyncio': asyncio}
+        exec("async def fetch(key, value):\n"
+             "    await asyncio.sleep(0.1)\n"
+             "    return 1 // value\n", namespace)
+        start = time.time()
+        res, failed = mapreduce.map(namespace['fetch'], list(range(500)),
+                                    backend='asyncio', return_failed=True)
+        # all 500 requests waited concurrently, on a single thread
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(list(failed), [0])
+        self.assertEqual(res[1:3], [1, 0])
+
+        results = mapreduce.imap(namespace['fetch'], [1, 2, 4], ordered=True,
+                                 backend='asyncio', num_workers=2)
+        self.assertEqual([key for key, _ in results], [0, 1, 2])
+
+    def test_progress(self):
+        tmpdir = tempfile.mkdtemp()
+        status = os.path.join(tmpdir, 'status.json')
+        try:
+            mapreduce.map(lambda i, x: 1 // x, list(range(100)),
+                          batch_size=10, progress=status)
+            with open(status) as fh:
+                s = json.load(fh)
+            self.assertEqual((s['total'], s['completed'], s['failed'],
+                              s['in_flight'], s['remaining']),
+                             (100, 99, 1, 0, 0))
+            self.assertGreater(s['rate']['1m'], 0)
+            self.assertIsNotNone(s['latency']['p50'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+        pool = threadpool.ThreadPool(n_workers=2)
+        futures = [pool.submit(time.sleep, 0.01) for _ in range(10)]
+        futures.append(pool.submit(int, 'not a number'))
+        pool.shutdown()
+        s = pool.progress.snapshot()
+        self.assertEqual((s['completed'], s['failed'], s['in_flight']),
+                         (10, 1, 0))
+        self.assertGreaterEqual(s['latency']['p90'], 0.01)
+
+
+class TestThrottle(unittest.TestCase):
+
+    def test_limiter(self):
+        limiter = throttle.Limiter('example.com', max_limit=4, initial=2)
+        active = []
+
+        def request(throttled=False):
+            limiter.acquire()
+            active.append(limiter.active)
+            time.sleep(0.01)
+            limiter.release(latency=0.01, throttled=throttled)
+
+        threads = [threading.Thread(target=request) for _ in range(40)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        self.assertLessEqual(max(active), 4)
+        self.assertEqual(limiter.limit, 4)  # ramped up to the max
+
+        request(throttled=True)  # multiplicative decrease
+        self.assertEqual(limiter.limit, 2)
+        request(throttled=True)  # the same congestion event
+        self.assertEqual(limiter.limit, 2)
+
+    def test_is_throttled(self):
+        def response(status, text='', **headers):
+            r = requests.Response()
+            r.status_code = status
+            r._content = text.encode('utf8')
+            r.headers.update(headers)
+            return r
+
+        self.assertTrue(throttle.is_throttled(response(429)))
+        self.assertTrue(throttle.is_throttled(response(
+            403, 'You have triggered an abuse detection mechanism')))
+        # exhausted token quota is handled by token rotation
+        self.assertFalse(throttle.is_throttled(response(
+            403, 'API rate limit exceeded', **{'X-RateLimit-Remaining': '0'})))
+        self.assertFalse(throttle.is_throttled(response(404)))
+
+
+class TestVersions(unittest.TestCase):
+    # mixed, pre-release and post-release versions
+    VERSIONS = ["", "0", "0.1", "0.1.1", "0.9", "1", "1.0", "1.0.0",
+                "1.0.0.0", "1.0a", "1.0a1", "1.0b2", "1.0rc1", "1.0rc2",
+                "1.0rc10", "1.0.dev3", "1.0.post1", "1.0-1", "1.0.1", "1.1",
+                "1.9", "1.10", "2.0", "10.0", "2016.12.01", "v1.0"]
+
+    def test_keys_order(self):
+        pairs = list(itertools.product(self.VERSIONS, repeat=2))
+        expected = [versions.compare(v1, v2) for v1, v2 in pairs]
+        res = versions.compare(pd.Series([v1 for v1, _ in pairs]),
+                               pd.Series([v2 for _, v2 in pairs]))
+        self.assertEqual(res.tolist(), expected)
+
+        # wherever compare() tells versions apart, keys sort the same way
+        version_keys = [tuple(int(x) for x in key) for key in
+                        versions.keys(pd.Series(self.VERSIONS))]
+        for (key1, key2), cmp in zip(
+                itertools.product(version_keys, repeat=2), expected):
+            if cmp:
+                self.assertEqual(int(key1 > key2) - int(key1 < key2), cmp)
+
+    def test_last_releases(self):
+        releases = pd.DataFrame([
+            # name, version, date, deps
+            ('a', '1.1', '2017-01-20', 'x,y'),
+            ('a', '1.0', '2017-01-05', 'x'),  # same month, earlier
+            ('a', '1.0.1', '2017-02-03', 'x'),  # backport
+            ('a', '2.0', '2017-04-11', 'y,z'),  # duplicate version
+            ('a', '2.0', '2017-03-01', 'y'),
+            ('a', '1.9', '2017-05-01', 'z'),  # backport
+            ('a', '2.1rc1', '2017-05-20', 'z'),  # alpha
+            ('a', '2.1', '2017-06-02', 'x'),
+            ('b', '0.2', '2017-02-15', 'a'),
+            ('b', '0.1', '2017-02-10', 'a,x'),
+            ('b', '0.1.1', '2017-03-01', 'x'),  # backport
+            ('b', '0.3', '2017-04-01', 'a'),
+            ('c', '1', '2017-01-01', 'a'),
+            ('c', '1.0', '2017-02-01', 'b'),  # equal to the previous one
+            ('c', '0.9', '2017-04-01', 'a'),  # backport
+            ('c', '1.0.0.1', '2017-03-11', 'a,b'),
+        ], columns=['name', 'version', 'date', 'deps'])
+
+        def releases_loop(deps):
+            """ The per-row implementation replaced by last_releases() """
+            deps = deps.set_index('name').sort_values("date")
+            deps = deps[~(deps["version"].map(versions.is_alpha))]
+            df = deps.groupby([deps.index, deps['date'].str[:7].rename(
+                'month')]).last().reset_index().sort_values(["name", "month"])
+            last_release = ""
+            last_package = ""
+            for _, row in df.iterrows():
+                if row["name"] != last_package:
+                    last_release = ""
+                    last_package = row["name"]
+                if versions.compare(row["version"], last_release) < 0:
+                    continue
+                last_release = row["version"]
+                yield row
+
+        columns = ['name', 'month', 'version', 'deps']
+        expected = pd.DataFrame(releases_loop(releases), columns=columns)
+        res = versions.last_releases(releases)[columns]
+        self.assertEqual(res.values.tolist(), expected.values.tolist())
+        self.assertEqual(res['version'].tolist(),
+                         ['1.1', '2.0', '2.0', '2.1', '0.2', '0.3',
+                          '1', '1.0', '1.0.0.1'])
+
+
+class TestGraph(unittest.TestCase):
+
+    def test_dependency_graph(self):
+        releases = pd.DataFrame({
+            'name': ['a', 'a', 'a', 'b', 'c'],
+            'month': ['2017-01', '2017-02', '2017-04', '2017-02', '2017-03'],
+            'deps': ['b', 'b', 'b,c,x', None, 'b']})
+        g = graph.DependencyGraph.from_releases(releases)
+        self.assertEqual(g.names.tolist(), ['a', 'b', 'c', 'x'])
+        # a didn't change dependencies in 2017-02
+        self.assertEqual(len(g.change_month), 4)
+
+        indptr, indices = g.snapshot('2017-03', reverse=True)
+        self.assertEqual(g.names[indices[indptr[1]:indptr[2]]].tolist(),
+                         ['a', 'c'])
+
+        ups = g.upstreams(end='2017-06')
+        self.assertEqual(ups.columns.tolist(),
+                         ['2017-01', '2017-02', '2017-03', '2017-04',
+                          '2017-05'])
+        self.assertTrue(pd.isnull(ups.loc['c', '2017-02']))
+        self.assertEqual(ups.loc['b', '2017-05'], set())
+        self.assertEqual(ups.loc['a', '2017-05'], {'b', 'c', 'x'})
+        dss = g.downstreams(end='2017-06')
+        self.assertEqual(dss.loc['c', '2017-04'], {'a'})
+        self.assertTrue(pd.isnull(dss.loc['a', '2017-04']))
+
+        edges = graph.EdgeTable.from_graph(g)
+        self.assertEqual(edges.to_frame().values.tolist(), [
+            ['a', 'b', '2017-01', None],
+            ['a', 'c', '2017-04', None],
+            ['a', 'x', '2017-04', None],
+            ['c', 'b', '2017-03', None]])
+        for month in ups.columns:
+            for reverse in (False, True):
+                for expected, res in zip(g.snapshot(month, reverse),
+                                         edges.snapshot(month, reverse)):
+                    self.assertEqual(expected.tolist(), res.tolist())
+        added, removed = edges.delta('2017-04')
+        self.assertEqual((added.tolist(), removed.tolist()), ([1, 2], []))
+        added, removed = edges.changes('2017-04', '2017-01')
+        self.assertEqual((added.tolist(), removed.tolist()), ([], [1, 2, 3]))
+
+        ds_path = tempfile.mkdtemp()
+        try:
+            fpath = os.path.join(ds_path, 'test.graph')
+            g.save(fpath)
+            loaded = graph.DependencyGraph.load(fpath)
+            self.assertFalse(loaded.set_indices.flags.writeable)
+            self.assertTrue(loaded.upstreams(end='2017-06').equals(ups))
+            self.assertTrue(loaded.downstreams(end='2017-06').equals(dss))
+        finally:
+            shutil.rmtree(ds_path)
+
+    def test_month_sets_duplicates(self):
+        # many changes of the same package land in the same snapshot cell
+        months = graph.month_labels('2014-01', '2017-01')
+        releases = pd.DataFrame({
+            'name': 'a', 'month': months,
+            'deps': ['b' if i % 2 else 'c' for i in range(len(months) - 1)]
+                    + ['b,c']})
+        g = graph.DependencyGraph.from_releases(releases)
+        indptr, indices = g.snapshot('2017-06')
+        self.assertEqual(sorted(g.names[indices[indptr[0]:indptr[1]]]),
+                         ['b', 'c'])
+        indptr, indices = g.snapshot('2016-11')
+        self.assertEqual(g.names[indices[indptr[0]:indptr[1]]].tolist(),
+                         ['c'])
+
 
 if __name__ == "__main__":
     unittest.main()
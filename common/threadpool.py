@@ -1,12 +1,149 @@
-
 import logging
 import multiprocessing
-import Queue
 import threading
 import time
 
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+from common import progress as pg
+
 CPU_COUNT = multiprocessing.cpu_count()
 
+logger = logging.getLogger("ghd.threadpool")
+
+# Future states
+PENDING = 'pending'
+RUNNING = 'running'
+FINISHED = 'finished'
+CANCELLED = 'cancelled'
+
+
+class CancelledError(Exception):
+    pass
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class Future(object):
+    """ Result of a task submitted to ThreadPool.
+    A minimal version of concurrent.futures.Future: result(), exception(),
+    cancel() and add_done_callback() """
+    def __init__(self):
+        self._state = PENDING
+        self._result = None
+        self._exception = None
+        self._condition = threading.Condition()
+        self._callbacks = []
+
+    def cancel(self):
+        """ Cancel the task if it hasn't started yet; True on success """
+        with self._condition:
+            if self._state == RUNNING or self._state == FINISHED:
+                return False
+            if self._state != CANCELLED:
+                self._state = CANCELLED
+                self._condition.notify_all()
+        self._run_callbacks()
+        return True
+
+    def cancelled(self):
+        return self._state == CANCELLED
+
+    def running(self):
+        return self._state == RUNNING
+
+    def done(self):
+        return self._state in (CANCELLED, FINISHED)
+
+    def _wait(self, timeout):
+        deadline = timeout is not None and time.time() + timeout
+        with self._condition:
+            while not self.done():
+                if deadline is False:
+                    self._condition.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError()
+                self._condition.wait(remaining)
+            if self._state == CANCELLED:
+                raise CancelledError()
+
+    def result(self, timeout=None):
+        """ Wait for the task and return its result, or raise its exception """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """ Call fn(future) when it is done, immediately if it already is """
+        with self._condition:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_running(self):
+        # type: () -> bool
+        """ Mark as running, False if the future was cancelled """
+        with self._condition:
+            if self._state == CANCELLED:
+                return False
+            self._state = RUNNING
+            return True
+
+    def _finish(self, result=None, exception=None):
+        with self._condition:
+            self._result = result
+            self._exception = exception
+            self._state = FINISHED
+            self._condition.notify_all()
+        self._run_callbacks()
+
+    def set_result(self, result):
+        self._finish(result=result)
+
+    def set_exception(self, exception):
+        self._finish(exception=exception)
+
+    def _run_callbacks(self):
+        with self._condition:
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                logger.exception(e)
+
+
+def as_completed(futures, timeout=None):
+    """ Iterate futures in order of completion
+    :param timeout: max total wait in seconds, raises TimeoutError
+    """
+    futures = list(futures)
+    done = queue.Queue()
+    for future in futures:
+        future.add_done_callback(done.put)
+    deadline = timeout is not None and time.time() + timeout
+    for _ in range(len(futures)):
+        try:
+            if deadline is False:
+                yield done.get()
+            else:
+                yield done.get(timeout=max(0, deadline - time.time()))
+        except queue.Empty:
+            raise TimeoutError()
+
 
 class ThreadPool(object):
     _threads = None
@@ -14,62 +151,117 @@ class ThreadPool(object):
     started = False
     callback_semaphore = None
 
-    def __init__(self, n_workers=None):
+    def __init__(self, n_workers=None, daemon=False, queue_size=None,
+                 lock_callbacks=False, progress=None):
         # the only reason to use threadpool in Python is IO (because of GIL)
         # so, we're not really limited with CPU and twice as many threads
         # is usually fine
         self.n = n_workers or CPU_COUNT * 2
-        self.queue = Queue.Queue()
-        self.callback_semaphore = threading.Lock()
+        # daemon pools are not waited for on exit (or garbage collection)
+        self.daemon = daemon
+        # max number of tasks waiting for a worker; when the queue is full,
+        # submit() blocks the producer until there is room (backpressure)
+        # Don't submit to a bounded pool from its own workers: if the queue
+        # is full, the worker will wait for itself
+        self.queue_size = queue_size
+        self.queue = queue.Queue(queue_size or 0)
+        # callbacks run concurrently in worker threads, so they have to be
+        # thread-safe (e.g. assigning a dict item or list.append is fine).
+        # lock_callbacks=True runs them one at a time instead
+        self.callback_semaphore = threading.Lock() if lock_callbacks else None
+        # completed/failed/in flight counts, throughput and latency of tasks;
+        # pass a progress.Progress with interval set to report periodically
+        self.progress = progress or pg.Progress('ThreadPool', interval=None)
 
     def start(self):
         assert not self.started, "The pool is already started"
 
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        def run_callback(callback, result):
+            try:
+                if self.callback_semaphore is None:
+                    callback(result)
+                else:
+                    with self.callback_semaphore:
+                        callback(result)
+            except Exception as e:
+                logger.exception(e)
+
         def worker():
-            while self.started or not self.queue.empty():
-                try:
-                    func, args, kwargs, callback = self.queue.get(False)
-                except Queue.Empty:
-                    time.sleep(0.1)
+            while True:
+                # blocks until there is a task; None is a signal to exit
+                task = self.queue.get()
+                if task is None:
+                    break
+                future, func, args, kwargs, callback = task
+                if not future.set_running():  # cancelled
+                    self.progress.discard()
                     continue
-                else:
-                    logging.debug("Got new data")
 
+                start = time.time()
                 try:
                     result = func(*args, **kwargs)
                 except Exception as e:
-                    logging.exception(e)
-                else:
-                    logging.debug("Processed data: %s -> %s", str(args), str(result))
-                    self.callback_semaphore.acquire()
-                    try:
-                        callback(result)
-                    except Exception as e:
-                        logging.exception(e)
-                    finally:
-                        self.callback_semaphore.release()
+                    self.progress.add(failed=1, latency=time.time() - start)
+                    logger.exception(e)
+                    future.set_exception(e)
+                    continue
+                self.progress.add(latency=time.time() - start)
+
+                if debug:  # don't stringify args and results for nothing
+                    logger.debug("Processed data: %s -> %s", args, result)
+                if callback is not None:
+                    run_callback(callback, result)
+                future.set_result(result)
 
         self._threads = [threading.Thread(target=worker) for _ in range(self.n)]
+        for t in self._threads:
+            t.daemon = self.daemon
         self.started = True
         [t.start() for t in self._threads]
 
     def submit(self, func, *args, **kwargs):
-        # submit is executed from the main thread and expected to by synchronous
-        callback = kwargs.get('callback')
-        if 'callback' in kwargs:
-            assert callable(callback), "Callback must be callable"
-            del(kwargs['callback'])
-
-        self.queue.put((func, args, kwargs, callback))
+        # type: (callable, *object, **object) -> Future
+        """ Schedule func(*args, **kwargs) and return a Future
+        Optional callback keyword argument is called with the result in the
+        worker thread, concurrently with other callbacks unless the pool was
+        created with lock_callbacks=True.
+        Blocks if the queue_size limit is reached """
+        callback = kwargs.pop('callback', None)
+        assert callback is None or callable(callback), \
+            "Callback must be callable"
 
         if not self.started:
             self.start()
 
+        future = Future()
+        self.progress.submitted()
+        self.queue.put((future, func, args, kwargs, callback))
+        return future
+
+    def map(self, func, *iterables):
+        """ Same as builtin map(), but calls are executed by the pool.
+        Results are yielded in order as soon as they're ready """
+        futures = [self.submit(func, *args) for args in zip(*iterables)]
+
+        def gen():
+            for future in futures:
+                yield future.result()
+        return gen()
+
     def shutdown(self):
-        # cleanup
+        """ Wait for all submitted tasks to complete and stop workers """
+        if not self.started:
+            return
         self.started = False
+        # workers exit after processing everything submitted before
+        for _ in self._threads:
+            self.queue.put(None)
         for t in self._threads:
             t.join()
+        self.progress.close()
 
     def __del__(self):
-        self.shutdown()
+        if not self.daemon:
+            self.shutdown()
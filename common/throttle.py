@@ -0,0 +1,193 @@
+"""Adaptive per-host concurrency limits for scrapers.
+
+Instead of hand-tuning number of workers for every scraping job, requests
+go through a per-host limiter. The limit is adjusted AIMD-style (the same
+way TCP congestion window is): it grows by one slot per "window" of
+successful requests and is cut in half on throttling responses (HTTP 429,
+GitHub abuse detection 403s, Retry-After), timeouts and connection errors,
+at most once per cooldown: requests in flight when the host started to
+push back are likely to fail as well, and shouldn't cut it any further.
+Growth also stops while latency is well above the best observed one.
+So, callers can use as many workers as they like; concurrent requests to a
+host will stay around the maximum it tolerates:
+
+    r = throttle.request('head', 'https://github.com/pandas-dev/pandas')
+
+Host limits (upper bounds) can be overridden by SCRAPER_HOST_LIMITS dict
+in settings.py
+"""
+
+import logging
+import threading
+import time
+
+import requests
+
+try:
+    from urllib.parse import urlparse
+except ImportError:  # Python 2
+    from urlparse import urlparse
+
+try:
+    import settings
+except ImportError:
+    settings = object()
+
+# max concurrent requests per host
+HOST_LIMITS = {
+    'github.com': 16,
+    # GitHub banned our IP (HTTP 403) with 8 workers, 6 were known to be safe
+    'api.github.com': 6,
+    'pypi.python.org': 32,
+    'pypi.org': 32,
+}
+HOST_LIMITS.update(getattr(settings, 'SCRAPER_HOST_LIMITS', None) or {})
+DEFAULT_HOST_LIMIT = 16
+# initial limit, ramped up from there
+INITIAL_LIMIT = 4
+# cooldown after throttling response without Retry-After header, seconds
+DEFAULT_COOLDOWN = 10
+# growth stops while latency is this many times higher than the best one
+LATENCY_TOLERANCE = 3
+# weight of a new observation in latency moving average
+LATENCY_ALPHA = 0.2
+
+logger = logging.getLogger("ghd.throttle")
+
+
+def is_throttled(response):
+    # type: (requests.Response) -> bool
+    """ Check if response indicates that we're sending too many requests
+    Exhausted GitHub API token quota (403 with X-RateLimit-Remaining: 0)
+    is not host congestion and is handled by GitHubAPI token rotation
+    """
+    if response.status_code == 429 or 'Retry-After' in response.headers:
+        return True
+    if response.status_code == 403:
+        if response.headers.get('X-RateLimit-Remaining') == '0':
+            return False
+        text = response.text[:1000].lower()
+        return 'abuse' in text or 'secondary rate limit' in text
+    return False
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return DEFAULT_COOLDOWN
+
+
+class Limiter(object):
+    """ AIMD concurrency limit for a single host
+
+    >>> limiter = Limiter('example.com', max_limit=8, initial=2)
+    >>> for _ in range(4):
+    ...     limiter.acquire()
+    ...     limiter.release(latency=0.1)
+    >>> limiter.limit > 2
+    True
+    >>> limiter.acquire()
+    >>> limiter.release(throttled=True, cooldown=0)
+    >>> limiter.limit < 2
+    True
+    """
+    def __init__(self, host, max_limit=DEFAULT_HOST_LIMIT, min_limit=1,
+                 initial=INITIAL_LIMIT):
+        self.host = host
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.active = 0
+        self.best_latency = None
+        self.latency = None  # exponential moving average
+        self._resume_at = 0  # no new requests before this time (cooldown)
+        self._decreased_at = None  # time of the last decrease
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """ Wait for a free slot """
+        with self._condition:
+            while True:
+                delay = self._resume_at - time.time()
+                if delay > 0:
+                    self._condition.wait(delay)
+                elif self.active >= int(self.limit):
+                    self._condition.wait()
+                else:
+                    break
+            self.active += 1
+
+    def release(self, latency=None, throttled=False, cooldown=None):
+        """ Free the slot and adjust the limit by the request outcome
+        :param latency: request duration in seconds, if succeeded
+        :param throttled: True if the host asked to slow down or failed
+        :param cooldown: seconds to pause all requests to the host
+        """
+        with self._condition:
+            self.active -= 1
+            if throttled:
+                now = time.time()
+                # responses to requests sent before the last decrease
+                # are a part of the same congestion event
+                if self._decreased_at is None or now - self._decreased_at \
+                        >= (cooldown or DEFAULT_COOLDOWN):
+                    self._decreased_at = now
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    logger.info("%s: throttled, concurrency limit %d",
+                                self.host, int(self.limit))
+                if cooldown:
+                    self._resume_at = max(self._resume_at, now + cooldown)
+            elif latency is not None:
+                self._observe(latency)
+                if self.latency <= self.best_latency * LATENCY_TOLERANCE:
+                    # +1 slot per limit successful requests, i.e. per "RTT"
+                    self.limit = min(self.max_limit,
+                                     self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def _observe(self, latency):
+        if self.best_latency is None or latency < self.best_latency:
+            self.best_latency = latency
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_ALPHA * (latency - self.latency)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(host):
+    # type: (str) -> Limiter
+    """ Return shared limiter for the host """
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = Limiter(
+                host, HOST_LIMITS.get(host, DEFAULT_HOST_LIMIT))
+        return _limiters[host]
+
+
+def request(method, url, **kwargs):
+    # type: (str, str, **object) -> requests.Response
+    """ requests.request(), limited by the host concurrency limiter
+    Throttled responses are returned as is, i.e. retries are up to caller
+    """
+    limiter = get_limiter(urlparse(url).netloc.lower())
+    limiter.acquire()
+    start = time.time()
+    try:
+        response = requests.request(method, url, **kwargs)
+    except (requests.exceptions.Timeout,
+            requests.exceptions.ConnectionError):
+        limiter.release(throttled=True)
+        raise
+    except Exception:
+        limiter.release()
+        raise
+    if is_throttled(response):
+        limiter.release(throttled=True, cooldown=_retry_after(response))
+    else:
+        limiter.release(latency=time.time() - start)
+    return response
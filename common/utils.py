@@ -2,14 +2,18 @@
 # from __future__ import unicode_literals
 
 import networkx as nx
+import numpy as np
 import pandas as pd
 
 from collections import defaultdict
 import datetime
 import logging
+import os
 
 from common import decorators as d
+from common import graph
 from common import mapreduce
+from common import throttle
 from common import versions
 import scraper
 
@@ -23,7 +27,9 @@ ECOSYSTEMS = {
 }
 
 logger = logging.getLogger("ghd")
-fs_cache = d.fs_cache('common')
+fs_cache = d.fs_cache('common', memory=d.memory_cache)
+# project x month feature matrices are memory mapped instead of parsed
+matrix_cache = d.fs_cache('common', serializer='mtx')
 
 # default start dates for ecosystem datasets. It is used for sanity checks
 START_DATES = {
@@ -126,14 +132,25 @@ def package_urls(ecosystem):
     urls = urls[urls.map(urls.value_counts()) == 1]
 
     def exists(project_name, url):
-        logger.info(project_name)
+        logger.debug(project_name)
         provider, project_url = scraper.get_provider(url)
         return provider.project_exists(project_url)
 
-    # - more than 16 threads make GitHub to choke even on public urls
-    # - some malformed URLs will result in NaN (e.g. NPM abwa-gulp and
-    #       barco-jobs), so need to fillna()
-    se = mapreduce.map(exists, urls, num_workers=16).fillna(False)
+    # - concurrency is adjusted by common.throttle to what GitHub tolerates,
+    #       so there is no point in having more workers than its host limit
+    # - some malformed URLs fail (e.g. NPM abwa-gulp and barco-jobs); they
+    #       are reported by map() as failed and considered nonexistent
+    # - it takes over a day for npm, so progress is checkpointed and
+    #       reported to a status file. Checkpointed results expire along
+    #       with the cache, so an abandoned run isn't resumed months later
+    checkpoint = os.path.join(
+        d.DATASET_PATH, "package_urls.%s.checkpoint" % ecosystem)
+    status = os.path.join(
+        d.DATASET_PATH, "package_urls.%s.status.json" % ecosystem)
+    se = mapreduce.map(exists, urls, checkpoint=checkpoint, retries=2,
+                       num_workers=throttle.HOST_LIMITS['github.com'],
+                       progress=status, checkpoint_expires=fs_cache.expires
+                       ).fillna(False)
 
     return urls[se]
 
@@ -211,7 +228,7 @@ def user_info(ecosystem):
         # single column dataframe is used instead of series to simplify
         # result type conversion
         username = row["login"]
-        logger.info("Processing %s", username)
+        logger.debug("Processing %s", username)
         fields = ['created_at', 'login', 'type', 'public_repos',
                   'followers', 'following']
         provider_name, _ = scraper.parse_url(row["url"])
@@ -233,11 +250,13 @@ def user_info(ecosystem):
     usernames = get_repo_usernames(urls).reset_index()
 
     # ensure uniqueness of (provider, login) pairs to avoid extra requests
-    # GitHub seems to ban IP (will get HTTP 403) if use 8 workers
+    # GitHub bans IP (HTTP 403) on too many concurrent requests; actual
+    # concurrency is adjusted to avoid it by common.throttle
     ui = mapreduce.map(
         get_user_info,
         usernames.groupby(["provider_name", "login"]).first().reset_index(),
-        num_workers=6)
+        num_workers=throttle.HOST_LIMITS['api.github.com'], retries=2,
+        rows='dict', progress=True)
 
     # TODO: move to provider
     ui["org"] = ui["type"].map({"Organization": True, "User": False})
@@ -329,11 +348,76 @@ def count_values(df):
         return df.apply(count)
 
 
-@d.memoize
+def releases(ecosystem):
+    # type: (str) -> pd.DataFrame
+    """ Get releases used to build dependency graph: the last stable release
+    of every package per month, except backports
+
+    :param ecosystem: str, {npm|pypi}
+    :return pd.DataFrame with name, month, version and deps columns,
+        deps is a comma separated string of upstreams
+    """
+    es = get_ecosystem(ecosystem)
+    deps = es.dependencies()[["version", "date", "deps"]].reset_index()
+    # will drop 101 record out of 4M for npm
+    deps = deps[deps["date"].notnull()]
+    # otherwise, there is a package in NPM dated 1970 which increases
+    # dataframe size manyfold
+    deps = deps[deps["date"] > START_DATES[ecosystem]]
+    df = versions.last_releases(deps)
+    return df[["name", "month", "version", "deps"]]
+
+
+@d.memoize(maxsize=2)
+def dependency_graph(ecosystem):
+    # type: (str) -> graph.DependencyGraph
+    """ Get compact monthly dependency graph, see common.graph
+    Stored in a binary file, so warm starts take seconds instead of
+    rebuilding it from releases (~66s for pypi)
+
+    :param ecosystem: str, {npm|pypi}
+    :return graph.DependencyGraph
+
+    >>> g = dependency_graph("pypi")
+    >>> indptr, indices = g.snapshot("2017-12")
+    >>> i = g.ids(["django"])[0]
+    >>> g.names[indices[indptr[i]:indptr[i+1]]].tolist()
+    ['pytz']
+    """
+    # the result is not a DataFrame, thus manual cache
+    fname = fs_cache.get_cache_fname(
+        "dependency_graph", ecosystem, extension="graph")
+    with d.file_lock(fname + ".lock"):
+        if not fs_cache.expired(fname):
+            return graph.DependencyGraph.load(fname)
+        g = graph.DependencyGraph.from_releases(releases(ecosystem))
+        g.save(fname)
+    return g
+
+
+@d.memoize(maxsize=2)
+def dependency_edges(ecosystem):
+    # type: (str) -> graph.EdgeTable
+    """ Get dependency edges with intervals of months they were valid for,
+    see common.graph.EdgeTable
+
+    :param ecosystem: str, {npm|pypi}
+    :return graph.EdgeTable
+
+    >>> edges = dependency_edges("pypi")
+    >>> added, removed = edges.delta("2017-12")
+    >>> len(added) > 0
+    True
+    """
+    return graph.EdgeTable.from_graph(dependency_graph(ecosystem))
+
+
+@d.memoize(maxsize=2)  # large results, keep one per ecosystem
 def upstreams(ecosystem):
     # type: (str) -> pd.DataFrame
     """ Get a dataframe with upstream dependencies sliced per month
-     ~66s for pypi, doesn't make sense to cache in filesystem
+    It is a DataFrame version of dependency_graph(); consider using the
+    graph directly, it takes orders of magnitude less memory
 
     :param ecosystem: str, {npm|pypi}
     :return pd.DataFrame, df.loc[package, month] = set([upstreams])
@@ -348,53 +432,16 @@ def upstreams(ecosystem):
     >>> ups.loc["django", "2017-12"] == {"pytz"}
     True
     """
-    def gen():
-        es = get_ecosystem(ecosystem)
-        deps = es.dependencies().sort_values("date")
-        # will drop 101 record out of 4M for npm
-        deps = deps[deps["date"].notnull()]
-        # otherwise, there is a package in NPM dated 1970 which increases
-        # dataframe size manyfold
-        deps = deps[deps["date"] > START_DATES[ecosystem]]
-        deps['deps'] = deps['deps'].map(
-            lambda x: set(x.split(",")) if x and pd.notnull(x) else set())
-        # remove alpha releases, 835K-> 744K (PyPI)
-        deps = deps[~(deps["version"].map(versions.is_alpha))]
-
-        # for several releases per month, use the last value
-        df = deps.groupby([deps.index, deps['date'].str[:7].rename('month')]
-                          ).last().reset_index().sort_values(["name", "month"])
-
-        last_release = ""
-        last_package = ""
-        for _, row in df.iterrows():
-            if row["name"] != last_package:
-                last_release = ""
-                last_package = row["name"]
-            # remove backports
-            if versions.compare(row["version"], last_release) < 0:
-                continue
-            last_release = row["version"]
-            yield row
-
-    df = pd.DataFrame(gen(), columns=["name", "month", "deps"])
-
     # pypi was started around 2000, first meaningful numbers around 2005
     # npm was started Jan 2010, first meaningful release 2010-11
-    # no need to cut off anything
-    idx = [dt.strftime("%Y-%m")
-           for dt in pd.date_range(df['month'].min(), 'now', freq="M")]
+    # no need to cut off anything, columns start from the first release
+    return dependency_graph(ecosystem).upstreams()
 
-    dependencies = df.set_index(["name", "month"], drop=True)["deps"]
-    # ffill can be dan with axis=1; Transpose here is to reindex
-    return dependencies.unstack(level=0).reindex(idx).fillna(method='ffill').T
 
-
-@d.memoize
+@d.memoize(maxsize=2)  # large results, keep one per ecosystem
 def downstreams(ecosystem):
     # type: (str) -> pd.DataFrame
     """ Basically, reversed upstreams
-    +25s to upstreams execution on PyPI dataset
 
     :param ecosystem: str, {pypi|npm}
     :return: pd.DataFrame, df.loc[project, month] = set([*projects])
@@ -414,18 +461,7 @@ def downstreams(ecosystem):
     >>> dss.loc["django", "2007-12"] == {"pyswim"}
     True
     """
-    uss = upstreams(ecosystem)
-
-    def gen(row):
-        s = defaultdict(set)
-        for pkg, dss in row.items():
-            if dss and pd.notnull(dss):
-                # add package as downstream to each of upstreams
-                for ds in dss:
-                    s[ds].add(pkg)
-        return pd.Series(s, name=row.name, index=row.index)
-
-    return uss.apply(gen, axis=0)
+    return dependency_graph(ecosystem).downstreams()
 
 
 def backporting(ecosystem, window=12):
@@ -464,14 +500,12 @@ def backporting(ecosystem, window=12):
     es = get_ecosystem(ecosystem)
     deps = es.dependencies().reset_index().sort_values(["name", "date"])
     projects = deps["name"].unique()
-    deps = deps[~(deps["version"].map(versions.is_alpha))]
+    deps = deps[~versions.is_alpha(deps["version"])]
     deps["prev_version"] = deps["version"].shift(1)
     deps["prev_name"] = deps["name"].shift(1)
     deps = deps[deps["name"] == deps["prev_name"]]
     deps = deps[["name", "version", "prev_version", "date"]]
-    deps["cmp"] = deps.apply(
-            lambda row: versions.compare(row["version"], row["prev_version"]),
-            axis=1)
+    deps["cmp"] = versions.compare(deps["version"], deps["prev_version"])
     backported = deps.loc[deps["cmp"] < 0, ["name", "date"]]
     backported["date"] = backported["date"].str[:7]
     backported["backported"] = 1
@@ -488,6 +522,28 @@ def backporting(ecosystem, window=12):
     return df.reindex(projects, fill_value=0).astype(bool).astype(int)
 
 
+def map_columns(func, df):
+    # type: (callable, pd.DataFrame) -> pd.DataFrame
+    """ df.apply(func, axis=0) for CPU bound func, using all cores
+    Columns (usually months) are processed in separate processes
+
+    >>> df = pd.DataFrame({'2017-01': [1, 2], '2017-02': [3, 4]})
+    >>> map_columns(lambda column: column * 2, df).loc[1, '2017-02']
+    8
+    >>> map_columns(lambda column: int('x'), df)
+    Traceback (most recent call last):
+        ...
+    ValueError: invalid literal for int() with base 10: 'x'
+    """
+    res, failed = mapreduce.map(lambda name, column: func(column),
+                                dict(df.items()), backend='process',
+                                return_failed=True)
+    # a missing column would silently become NaN (or 0 after .fillna())
+    if failed:
+        raise next(iter(failed.values()))
+    return pd.DataFrame(res, index=df.index, columns=df.columns)
+
+
 def cumulative_dependencies(deps):
     """
    ~160 seconds for pypi upstreams, ?? for downstreams
@@ -522,7 +578,7 @@ def cumulative_dependencies(deps):
         return pd.Series(dependencies.index, index=dependencies.index).map(
             traverse).rename(dependencies.name)
 
-    return deps.apply(gen, axis=0)
+    return map_columns(gen, deps)
 
 
 def centrality(how, graph):
@@ -584,10 +640,10 @@ def dependencies_centrality(ecosystem, centrality_type):
 
         return pd.Series(centrality(centrality_type, g), index=stub.index)
 
-    return uss.apply(gen, axis=0).fillna(0)
+    return map_columns(gen, uss).fillna(0)
 
 
-@d.memoize
+@d.memoize(maxsize=2)  # large results, keep one per ecosystem
 def contributors(ecosystem, months=1):
     # type: (str) -> pd.DataFrame
     """ Get a historical list of developers contributing to ecosystem projects
@@ -691,7 +747,7 @@ def contributors_centrality(ecosystem, centrality_type):
         # ct is now nx.DegreeView, need to transform into dict
         return pd.Series(dict(ct), index=stub.index)
 
-    return contras.apply(gen, axis=0).fillna(0)
+    return map_columns(gen, contras).fillna(0)
 
 
 def dead_projects(ecosystem, window, threshold):
@@ -713,7 +769,7 @@ def dead_projects(ecosystem, window, threshold):
     return dead
 
 
-@fs_cache
+@matrix_cache
 def monthly_data(ecosystem, feature):
     # type: (str, str) -> pd.DataFrame
     """
@@ -1,12 +1,29 @@
 
+import numpy as np
+import pandas as pd
+
+import itertools
+import numbers
 import re
 
+STABLE_PATTERN = r"^\d+(\.\d+)*$"
+CHUNK_PATTERN = r"(\d+|[A-Za-z]\w*)"
+_CHUNK_RE = re.compile(CHUNK_PATTERN)
+
+# version key markers; numeric chunks are stored as is (non-negative),
+# text chunks (prerelease labels) as negative numbers below END, so that
+# 1.0rc1 < 1.0 < 1.0.1
+END = -1  # padding after the last chunk
+# numeric chunks with more digits are capped at MAX_NUMBER
+MAX_DIGITS = 18
+MAX_NUMBER = 10 ** MAX_DIGITS - 1
+
 
 def is_alpha(version):
     """ Check whether the provided version is not a stable release
     This method is looking if version matches to digits and dots only
-    :param version: str, version string
-    :return: bool
+    :param version: str, version string, or pd.Series of them
+    :return: bool, or pd.Series of bool for pd.Series input
 
     >>> is_alpha("1.0.0")
     False
@@ -14,8 +31,12 @@ def is_alpha(version):
     True
     >>> is_alpha("0.0.0.0")
     False
+    >>> is_alpha(pd.Series(["1.0.0", "1.0rc1"])).tolist()
+    [False, True]
     """
-    return not re.match("^\d+(\.\d+)*$", version.strip())
+    if isinstance(version, pd.Series):
+        return ~version.astype(str).str.strip().str.match(STABLE_PATTERN)
+    return not re.match(STABLE_PATTERN, version.strip())
 
 
 def parse(version):
@@ -32,7 +53,7 @@ def parse(version):
     [0, 11, 23, 'rc1']
     """
     chunks = []
-    for chunk in re.findall(r"(\d+|[A-Za-z]\w*)", version):
+    for chunk in re.findall(CHUNK_PATTERN, version):
         try:
             chunk = int(chunk)
         except ValueError:
@@ -45,6 +66,10 @@ def compare(ver1, ver2):
     # type: (str, str) -> int
     """Compares two version string, returning {-1|0|1} just as cmp().
     (-1: ver1 < ver2, 0: ver1==ver2, 1: ver1 > ver2)
+    Text chunks (prerelease labels) are lower than numbers in the same
+    position. If one of the arguments is a pd.Series, the comparison is
+    vectorized and a pd.Series is returned.
+
     >>> compare("0.1.1", "0.1.2")
     -1
     >>> compare("0.1.2", "0.1.1")
@@ -55,17 +80,176 @@ def compare(ver1, ver2):
     1
     >>> compare("0.1.1rc1", "0.1.1")
     -1
+    >>> compare("0.1a", "0.1.1")
+    -1
+    >>> compare(pd.Series(["0.1.1", "0.1.2", "0.1", "0.1.1rc1"]),
+    ...         pd.Series(["0.1.2", "0.1.1", "0.1.1", "0.1.1"])).tolist()
+    [-1, 1, 0, -1]
     """
+    if isinstance(ver1, pd.Series) or isinstance(ver2, pd.Series):
+        return _compare_series(ver1, ver2)
     chunks1 = parse(str(ver1))
     chunks2 = parse(str(ver2))
     min_len = min(len(chunks1), len(chunks2))
     for i in range(min_len):
-        if chunks1[i] > chunks2[i]:
+        chunk1, chunk2 = _order(chunks1[i]), _order(chunks2[i])
+        if chunk1 > chunk2:
             return 1
-        elif chunks1[i] < chunks2[i]:
+        elif chunk1 < chunk2:
             return -1
-    if len(chunks1) > min_len and isinstance(chunks1[min_len], str):
+    if len(chunks1) > min_len and not _is_number(chunks1[min_len]):
         return -1
-    if len(chunks2) > min_len and isinstance(chunks2[min_len], str):
+    if len(chunks2) > min_len and not _is_number(chunks2[min_len]):
         return 1
     return 0
+
+
+def _is_number(chunk):
+    # text chunks can be str or unicode on Python 2, numbers int or long
+    return isinstance(chunk, numbers.Integral)
+
+
+def _order(chunk):
+    # text chunks go before numbers; without this, Python 2 compares them
+    # the other way around and Python 3 raises TypeError
+    return (1, chunk) if _is_number(chunk) else (0, chunk)
+
+
+def keys(versions):
+    # type: (pd.Series) -> np.ndarray
+    """ Parse versions into a 2D int64 array of version keys, one row per
+    version. Each row holds version chunks, padded with END.
+    Text chunks are replaced with negative numbers below END, in
+    alphabetical order, so they are only comparable within the same call.
+    Every distinct version string is only parsed once.
+
+    >>> keys(pd.Series(["1.0", "1.0rc1", "1.0"]))
+    array([[ 1,  0, -1],
+           [ 1,  0, -2],
+           [ 1,  0, -1]])
+    """
+    unique_keys, codes = _unique_keys(versions)
+    return unique_keys[codes]
+
+
+def _unique_keys(versions):
+    # type: (pd.Series) -> (np.ndarray, np.ndarray)
+    """ keys() of distinct versions, and positions of versions in it """
+    codes, uniques = pd.factorize(versions.astype(str))
+    parsed = [_CHUNK_RE.findall(version) for version in uniques]
+    lengths = np.array([len(chunks) for chunks in parsed], dtype=np.int64)
+    width = max(lengths.max() if len(lengths) else 0, 1)
+    res = np.full((len(uniques), width), END, dtype=np.int64)
+    if not lengths.sum():
+        return res, codes
+
+    chunks = pd.Series(list(itertools.chain.from_iterable(parsed)))
+    numeric = chunks.str.isdigit().values
+    numbers = chunks[numeric]
+    values = np.empty(len(chunks), dtype=np.int64)
+    values[numeric] = numbers.where(
+        numbers.str.len() <= MAX_DIGITS, str(MAX_NUMBER)).astype(np.int64)
+    labels, label_codes = np.unique(chunks[~numeric].values.astype(str),
+                                    return_inverse=True)
+    values[~numeric] = label_codes - len(labels) + END
+
+    rows = np.repeat(np.arange(len(uniques)), lengths)
+    # position of every chunk within its version
+    positions = np.arange(len(chunks)) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths)
+    res[rows, positions] = values
+    return res, codes
+
+
+def is_backport(versions, groups=None):
+    # type: (pd.Series, pd.Series) -> pd.Series
+    """ Check whether a version is lower than the last non-backport version
+    in the same group, e.g. releases of a package sorted by date.
+    Same as a loop over versions, skipping ones where
+    compare(version, last_version) < 0, but processes all groups at once
+
+    :param versions: pd.Series of version strings
+    :param groups: pd.Series of group labels (e.g. package names), with
+        the same index. All versions are in the same group by default
+    :return: pd.Series of bool
+
+    >>> is_backport(pd.Series(["1.0", "1.1", "1.0.1", "2.0", "1.0"]),
+    ...             pd.Series(["a", "a", "a", "a", "b"])).tolist()
+    [False, False, True, False, False]
+    >>> is_backport(pd.Series(["0.3", "0", "0.1", "0.0.1"])).tolist()
+    [False, False, False, True]
+    """
+    if groups is None:
+        groups = pd.Series(0, index=versions.index)
+    version_keys = keys(versions)
+    group_codes, group_labels = pd.factorize(groups)
+    # position of a version within its group
+    steps = groups.groupby(group_codes).cumcount().values
+    order = np.argsort(steps, kind='mergesort')
+    bounds = np.searchsorted(steps[order], np.arange(steps.max() + 2)
+                             if len(steps) else [0])
+
+    # last non-backport version of every group; empty version initially
+    last = np.full((len(group_labels), version_keys.shape[1]), END,
+                   dtype=np.int64)
+    res = np.zeros(len(versions), dtype=bool)
+    # loop over positions within groups, all groups at once
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        rows = order[start:end]
+        rows_groups = group_codes[rows]
+        backport = _compare_keys(version_keys[rows], last[rows_groups]) < 0
+        res[rows] = backport
+        last[rows_groups[~backport]] = version_keys[rows[~backport]]
+    return pd.Series(res, index=versions.index)
+
+
+def last_releases(releases):
+    # type: (pd.DataFrame) -> pd.DataFrame
+    """ Last stable release of every package per month, except backports
+
+    :param releases: pd.DataFrame with name, version and date columns,
+        dates are strings starting with YYYY-MM, in any order
+    :return: pd.DataFrame of the remaining rows sorted by name and month,
+        with an extra month column
+
+    >>> last_releases(pd.DataFrame({
+    ...     'name': ['a', 'a', 'a', 'a'],
+    ...     'version': ['1.1', '1.0', '1.0.1', '2.0rc1'],
+    ...     'date': ['2017-01-20', '2017-01-05', '2017-02-01', '2017-03-01']
+    ... }))[['month', 'version']].values.tolist()
+    [['2017-01', '1.1']]
+    """
+    # remove alpha releases, 835K-> 744K (PyPI)
+    releases = releases[~is_alpha(releases["version"])]
+    # for several releases per month, use the last value
+    releases = releases.assign(month=releases["date"].str[:7])
+    df = releases.sort_values("date", kind="mergesort").drop_duplicates(
+        ["name", "month"], keep="last").sort_values(["name", "month"])
+    return df[~is_backport(df["version"], df["name"])]
+
+
+def _compare_keys(keys1, keys2):
+    # type: (np.ndarray, np.ndarray) -> np.ndarray
+    """ Vectorized compare() of two arrays of keys of the same shape """
+    # first position where versions differ, if any
+    differ = keys1 != keys2
+    pos = differ.argmax(axis=1)
+    rows = np.arange(len(keys1))
+    chunk1, chunk2 = keys1[rows, pos], keys2[rows, pos]
+    res = np.sign(chunk1 - chunk2) * differ.any(axis=1)
+    # a version ended, while the other continues with a number: same as
+    # compare(), it is considered equal
+    res[((chunk1 == END) & (chunk2 > END)) |
+        ((chunk2 == END) & (chunk1 > END))] = 0
+    return res
+
+
+def _compare_series(ver1, ver2):
+    """ Vectorized compare(); two pd.Series are aligned by index """
+    index = (ver1 if isinstance(ver1, pd.Series) else ver2).index
+    ver1, ver2 = [pd.Series(ver, index=index) if isinstance(ver, pd.Series)
+                  else pd.Series(ver, index=index).astype(str)
+                  for ver in (ver1, ver2)]
+    both = keys(pd.concat([ver1, ver2]))
+    return pd.Series(_compare_keys(both[:len(index)], both[len(index):]),
+                     index=index)
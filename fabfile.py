@@ -13,9 +13,14 @@ fab.env.hosts = settings.DEPLOY_HOSTS
 def test():
     with fab.settings(warn_only=True):
         fab.local("python -m unittest common.test")
+        fab.local("python -m doctest common/decorators.py")
         fab.local("python -m doctest common/email_utils.py")
+        fab.local("python -m doctest common/graph.py")
+        fab.local("python -m doctest common/manifest.py")
         fab.local("python -m doctest common/utils.py")
         fab.local("python -m doctest common/mapreduce.py")
+        fab.local("python -m doctest common/progress.py")
+        fab.local("python -m doctest common/throttle.py")
         fab.local("python -m doctest common/versions.py")
         fab.local("python -m doctest pypi/utils.py")
         fab.local("python -m doctest scraper/utils.py")
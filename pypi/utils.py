@@ -19,7 +19,9 @@ from xml.etree import ElementTree
 
 from common import decorators as d
 from common import email_utils as email
+from common import progress
 from common import threadpool
+from common import throttle
 from common import versions
 import scraper
 
@@ -182,7 +184,8 @@ class Package(object):
     def _request(*path):
         for i in range(3):
             try:
-                r = requests.get("/".join((PYPI_URL,) + path), timeout=TIMEOUT)
+                r = throttle.request(
+                    'get', "/".join((PYPI_URL,) + path), timeout=TIMEOUT)
             except requests.exceptions.Timeout:
                 continue
             r.raise_for_status()
@@ -608,7 +611,7 @@ def packages_info():
                 continue
             for org in orgs:
                 url = "%s/%s" % (org, package)
-                r = requests.get("https://github.com/" + url)
+                r = throttle.request('get', "https://github.com/" + url)
                 if r.status_code == 200:
                     urls[package] = url
                     break
@@ -632,7 +635,7 @@ def dependencies():
         - raw_build_dependencies
     """
     deps = {}
-    fname = fs_cache.get_cache_fname(".deps_and_size.cache")
+    fname = fs_cache.get_cache_fname(".deps_and_size.cache", extension="csv")
 
     if os.path.isfile(fname):
         logger.info("deps_and_size() cache file already exists. "
@@ -654,7 +657,10 @@ def dependencies():
                     "Computing everything from scratch is a lengthy process "
                     "and will likely take a week or so")
 
-    tp = threadpool.ThreadPool()
+    # there are millions of releases; queue_size keeps the producer from
+    # queueing all of them before the first one is processed
+    tp = threadpool.ThreadPool(
+        queue_size=1000, progress=progress.Progress('pypi.dependencies'))
     logger.info("Starting a threadppol with %d workers...", tp.n)
 
     package_names = packages_info().index
@@ -675,7 +681,7 @@ def dependencies():
         deps[(output["name"], output["version"])] = output
 
     for package_name in package_names:
-        logger.info("Processing %s", package_name)
+        logger.debug("Processing %s", package_name)
         try:
             p = Package(package_name)
         except PackageDoesNotExist:
@@ -683,10 +689,10 @@ def dependencies():
 
         for version, release_date in p.releases(True, True):
             if (package_name, version) not in deps:
-                logger.info("    %s", version)
+                logger.debug("    %s", version)
                 tp.submit(do, package_name, version, release_date, callback=done)
             else:
-                logger.info("    %s (cached)", version)
+                logger.debug("    %s (cached)", version)
 
     # wait for workers to complete
     tp.shutdown()
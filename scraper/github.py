@@ -6,6 +6,8 @@ import json
 import logging
 from typing import Iterable
 
+from common import throttle
+
 try:
     import settings
 except ImportError:
@@ -121,7 +123,7 @@ class GitHubAPIToken(object):
         # "Accept": "application/vnd.github.v3+json"}
 
         # might throw a timeout
-        r = requests.request(
+        r = throttle.request(
             method, self.api_url + url, params=params, data=data,
             headers=self._headers,  timeout=self.timeout)
 
@@ -318,7 +320,12 @@ class GitHubAPI(object):
 
     @staticmethod
     def project_exists(repo_name):
-        return bool(requests.head("https://github.com/" + repo_name))
+        # renamed repositories redirect to the new name, i.e. exist
+        r = throttle.request('head', "https://github.com/" + repo_name,
+                             allow_redirects=False)
+        if throttle.is_throttled(r):  # not a reason to consider it missing
+            r.raise_for_status()
+        return bool(r)
 
     @staticmethod
     def canonical_url(project_url):
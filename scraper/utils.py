@@ -11,6 +11,11 @@ from common import decorators
 from common import email_utils as email
 from scraper import github
 
+try:
+    import settings
+except ImportError:
+    settings = object()
+
 """ First contrib date without MIN_DATE restriction:
 > fcd = utils.first_contrib_dates("pypi").dropna()
 > df = pd.DataFrame(fcd.rename("fcd"))
@@ -38,7 +43,15 @@ MIN_DATE = "1997"
 # username to be used all unidentified users
 DEFAULT_USERNAME = "-"
 
-fs_cache = decorators.typed_fs_cache('scraper')
+# raw commit and issue dumps are large and rarely read, so they are
+# compressed by default. Set SCRAPER_RAW_COMPRESSION = 'none' to disable
+RAW_COMPRESSION = getattr(settings, 'SCRAPER_RAW_COMPRESSION', None) or 'gzip'
+if RAW_COMPRESSION == 'none':
+    RAW_COMPRESSION = None
+
+fs_cache = decorators.typed_fs_cache(
+    'scraper', memory=decorators.memory_cache,
+    compression={'raw': RAW_COMPRESSION})
 
 logger = logging.getLogger("ghd.scraper")
 
@@ -320,7 +320,7 @@ def adjacency_matrix():
     # type: () -> pd.DataFrame
     # the resulting matrix is huge and makes pd.read_csv to freeze
     # thus, manual cache
-    fname = fs_cache.get_cache_fname("adjacency")
+    fname = fs_cache.get_cache_fname("adjacency", extension="csv")
     if fs_cache.expired(fname):
         df = parse(AdjacencyHandler).matrix
         df.to_csv(fname)